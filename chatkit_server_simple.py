@@ -5,10 +5,11 @@ Simple ChatKit Server for Pet Food Assistant
 This follows the official ChatKit documentation pattern exactly.
 """
 
+import asyncio
 import logging
 import os
 import sys
-import uuid
+from contextvars import ContextVar
 from typing import Any, AsyncIterator
 
 # Add current directory to path for imports
@@ -17,6 +18,8 @@ sys.path.append(os.path.dirname(__file__))
 # ChatKit imports
 from chatkit.server import ChatKitServer, StreamingResult
 from chatkit.types import ThreadMetadata, UserMessageItem, ThreadStreamEvent, UserMessageContent, Attachment, AttachmentCreateParams, ImageAttachment, FileAttachment
+from chatkit.types import AssistantMessageItem, ClientToolCallItem, WidgetItem, WorkflowItem, TaskItem, HiddenContextItem, EndOfTurnItem
+from chatkit.types import ThreadItemDoneEvent, ErrorEvent, ThreadItem, Page
 from chatkit.store import Store, AttachmentStore
 from chatkit.agents import AgentContext, stream_agent_response, simple_to_agent_input, ThreadItemConverter
 
@@ -25,7 +28,11 @@ from agents.agent import Agent
 from agents.run import Runner, RunConfig
 
 # Pet agent import
-from pet_agent import pet_asistant
+from pet_agent import pet_asistant, close_search_client
+
+# OpenAI Responses input types built by the converter
+from openai.types.responses.response_input_image_param import ResponseInputImageParam
+from openai.types.responses.response_input_file_param import ResponseInputFileParam
 
 # FastAPI imports
 from fastapi import FastAPI, Request, HTTPException
@@ -50,6 +57,15 @@ class PetChatKitServer(ChatKitServer):
         self.converter = PetAssistantThreadItemConverter(data_store)
         logger.info("Pet ChatKit server initialized")
     
+    async def _has_history(self, thread_id: str, input_id: str, context: Any) -> bool:
+        """Whether the thread holds any item other than the incoming message."""
+        has_items_besides = getattr(self.store, "has_items_besides", None)
+        if has_items_besides is not None:
+            return await has_items_besides(thread_id, input_id, context)
+        # Generic ChatKit Store: two items are enough to tell
+        page = await self.store.load_thread_items(thread_id, None, 2, "asc", context)
+        return any(item.id != input_id for item in page.data)
+    
     async def respond(
         self,
         thread: ThreadMetadata,
@@ -59,7 +75,7 @@ class PetChatKitServer(ChatKitServer):
         """
         Handle ChatKit requests following official documentation pattern.
         """
-        logger.info(f"Processing request for thread {thread.id}")
+        logger.info("Processing request for thread %s", thread.id)
         
         # Create agent context
         agent_context = AgentContext(
@@ -70,7 +86,7 @@ class PetChatKitServer(ChatKitServer):
         
         # Get previous_response_id from thread metadata for conversation continuity
         previous_response_id = thread.metadata.get("previous_response_id")
-        logger.info(f"Previous response ID: {previous_response_id}")
+        logger.info("Previous response ID: %s", previous_response_id)
         
         # Convert input to agent format - use previous_response_id optimization
         if input:
@@ -79,17 +95,22 @@ class PetChatKitServer(ChatKitServer):
                 # The Agent SDK will use previous_response_id to reference the conversation history
                 agent_input = await self.converter.to_agent_input([input])
                 logger.info("Using previous_response_id optimization - sending only current message")
+            elif not await self._has_history(thread.id, input.id, context):
+                # Brand-new thread - the input is the whole conversation, nothing to load
+                agent_input = await self.converter.to_agent_input([input])
+                logger.info("New thread - sending only current message")
             else:
                 # First message - load all conversation history
                 thread_items = await self.store.load_thread_items(
                     thread.id, None, 100, "asc", context
                 )
-                logger.info(f"First message - loaded {len(thread_items.data)} items from thread {thread.id}")
+                logger.info("First message - loaded %d items from thread %s", len(thread_items.data), thread.id)
                 agent_input = await self.converter.to_agent_input(thread_items.data)
         else:
             agent_input = []
         
-        logger.info(f"Agent input: {agent_input}")
+        # The input can carry whole base64 attachments; only render it when debugging
+        logger.debug("Agent input: %s", agent_input)
         
         # Run agent using official pattern with custom workflow name and previous_response_id
         result = Runner.run_streamed(
@@ -103,305 +124,685 @@ class PetChatKitServer(ChatKitServer):
         # Stream response
         logger.info("Starting to stream agent response...")
         event_count = 0
-        async for event in stream_agent_response(agent_context, result):
-            event_count += 1
-            # Only log important events, not every update
-            if event_count == 1 or "Done" in type(event).__name__ or "Error" in type(event).__name__:
-                logger.info(f"Streaming event {event_count}: {type(event).__name__}")
-            yield event
+        # Per-event logging costs a level check per token otherwise; decide once per stream
+        log_events = logger.isEnabledFor(logging.DEBUG)
+        # Hold the items ChatKit saves during this turn and write them in one transaction
+        # at the end (SimpleSQLiteStore only); no transaction stays open while streaming
+        begin_item_buffer = getattr(self.store, "begin_item_buffer", None)
+        if begin_item_buffer is not None:
+            begin_item_buffer(thread.id)
+        try:
+            async for event in stream_agent_response(agent_context, result):
+                event_count += 1
+                # Only log important events, not every update
+                if log_events and (event_count == 1 or isinstance(event, (ThreadItemDoneEvent, ErrorEvent))):
+                    logger.debug("Streaming event %d: %s", event_count, type(event).__name__)
+                yield event
+        finally:
+            if begin_item_buffer is not None:
+                await self.store.flush_item_buffer(thread.id)
         
-        logger.info(f"Finished streaming {event_count} events")
+        logger.info("Finished streaming %d events", event_count)
         
-        # Save the response_id for conversation continuity
-        if result.last_response_id:
+        # Save the response_id for conversation continuity (skip the row rewrite if unchanged)
+        if result.last_response_id and result.last_response_id != previous_response_id:
             thread.metadata["previous_response_id"] = result.last_response_id
             await self.store.save_thread(thread, context)
-            logger.info(f"Saved previous_response_id: {result.last_response_id}")
+            logger.info("Saved previous_response_id: %s", result.last_response_id)
 
 # =============================================================================
 # SIMPLE SQLITE STORE
 # =============================================================================
 
+import base64
+import secrets
 import sqlite3
-import json
-import uuid
+import time
+from collections import OrderedDict
 from datetime import datetime
+from pydantic import TypeAdapter, ValidationError
+
+# ThreadItem subclass for each stored item type
+_ITEM_TYPE_MAP = {
+    "user_message": UserMessageItem,
+    "assistant_message": AssistantMessageItem,
+    "client_tool_call": ClientToolCallItem,
+    "widget": WidgetItem,
+    "workflow": WorkflowItem,
+    "task": TaskItem,
+    "hidden_context": HiddenContextItem,
+    "end_of_turn": EndOfTurnItem,
+}
+
+# Validates a whole page of stored items (a JSON array) in one call
+_ITEM_LIST_ADAPTER = TypeAdapter(list[ThreadItem])
+_THREAD_LIST_ADAPTER = TypeAdapter(list[ThreadMetadata])
+
+# Page queries spelled out once per (order, has cursor) so the SQL text is
+# identical on every call and always hits the connection's statement cache
+_ITEM_PAGE_SQL = {
+    (order, with_after): (
+        "SELECT id, type, data FROM items WHERE thread_id = ?"
+        + ((" AND id < ?" if order == "desc" else " AND id > ?") if with_after else "")
+        + f" ORDER BY id {order} LIMIT ?"
+    )
+    for order in ("asc", "desc")
+    for with_after in (False, True)
+}
+_THREAD_PAGE_SQL = {
+    (order, with_after): (
+        "SELECT id, data FROM threads"
+        + ((" WHERE id < ?" if order == "desc" else " WHERE id > ?") if with_after else "")
+        + f" ORDER BY id {order} LIMIT ?"
+    )
+    for order in ("asc", "desc")
+    for with_after in (False, True)
+}
+
+def _connect(db_path: str) -> sqlite3.Connection:
+    """Open an autocommit connection with the PRAGMAs both stores rely on."""
+    # Every statement below is fixed text, so a roomier statement cache keeps all of them compiled
+    conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None, cached_statements=256)
+    # page_size only takes effect before the first page is written, so set it on new files
+    if conn.execute("PRAGMA page_count").fetchone()[0] == 0:
+        conn.execute("PRAGMA page_size=8192")
+    # WAL is persistent in the file; the rest are per-connection
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-64000")
+    conn.execute("PRAGMA mmap_size=268435456")
+    # Both stores write to the same file; wait for the other's write lock instead of failing
+    conn.execute("PRAGMA busy_timeout=5000")
+    return conn
+
+
+def _attachment_base64(data) -> str:
+    """Base64 text for a stored attachment payload.
+    
+    Uploads are stored as raw bytes (BLOB) and only encoded here, when a data URL
+    is built; rows written before that already hold base64 text.
+    """
+    if isinstance(data, bytes):
+        return base64.b64encode(data).decode("ascii")
+    return data or ""
+
+
+# Multiple of 3, so each chunk's base64 has no padding and the pieces concatenate cleanly
+_BLOB_CHUNK = 3 * 21845
+
+
+def _read_attachment_base64(conn: sqlite3.Connection, attachment_id: str) -> str:
+    """Base64 text of an attachment's payload ("" if missing), streamed from the BLOB.
+    
+    Reads through incremental BLOB I/O in fixed-size chunks, so the raw bytes are
+    never materialized as one object next to their encoding.
+    """
+    row = conn.execute(
+        "SELECT rowid, typeof(data) FROM attachments WHERE id = ?", (attachment_id,)
+    ).fetchone()
+    if row is None:
+        return ""
+    rowid, kind = row
+    if kind != "blob":
+        return _attachment_base64(
+            conn.execute("SELECT data FROM attachments WHERE rowid = ?", (rowid,)).fetchone()[0]
+        )
+    parts = []
+    with conn.blobopen("attachments", "data", rowid, readonly=True) as blob:
+        while chunk := blob.read(_BLOB_CHUNK):
+            parts.append(base64.b64encode(chunk).decode("ascii"))
+    return "".join(parts)
+
+
+# Database files whose schema this process has already created/migrated
+_INITIALIZED_DB_PATHS: set[str] = set()
+
+
+def _init_schema(conn: sqlite3.Connection, db_path: str) -> None:
+    """Create (and migrate) every table and index both stores use, once per file.
+    
+    SimpleSQLiteStore and SimpleSQLiteAttachmentStore share one file, so whichever
+    is created first sets up the whole schema in a single transaction.
+    """
+    key = db_path if db_path == ":memory:" else os.path.realpath(db_path)
+    if key in _INITIALIZED_DB_PATHS:
+        return
+    conn.execute("BEGIN")
+    try:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS threads (
+                id TEXT PRIMARY KEY,
+                created_at TEXT NOT NULL,
+                data BLOB NOT NULL
+            )
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS items (
+                id TEXT PRIMARY KEY,
+                thread_id TEXT NOT NULL,
+                type TEXT,
+                created_at TEXT NOT NULL,
+                data BLOB NOT NULL
+            )
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS attachments (
+                id TEXT PRIMARY KEY,
+                name TEXT NOT NULL,
+                mime_type TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                data BLOB NOT NULL,
+                created_at TEXT NOT NULL
+            )
+        """)
+        # Older databases predate the type column; add it and backfill from the JSON
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(items)")}
+        if "type" not in columns:
+            conn.execute("ALTER TABLE items ADD COLUMN type TEXT")
+            conn.execute("UPDATE items SET type = json_extract(data, '$.type')")
+        # Page reads are "WHERE thread_id = ? [AND id > ?] ORDER BY id"; index them as a range scan
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_items_thread ON items(thread_id, id)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_threads_created_at ON threads(created_at)")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+    if key != ":memory:":
+        _INITIALIZED_DB_PATHS.add(key)
+
+
+def _close(conn: sqlite3.Connection) -> None:
+    # Let SQLite re-analyze tables whose stats went stale so the planner keeps using the indexes
+    conn.execute("PRAGMA optimize")
+    conn.close()
+
+
+_last_id_ns = 0
+
+
+def _sortable_id(prefix: str) -> str:
+    """Creation-ordered id: a monotonic nanosecond timestamp plus a random suffix.
+    
+    Pages are read with ORDER BY id, so ids that sort by creation time keep
+    pagination in conversation order and append to the end of the index.
+    """
+    global _last_id_ns
+    _last_id_ns = max(time.time_ns(), _last_id_ns + 1)
+    return f"{prefix}_{_last_id_ns:016x}{secrets.token_hex(2)}"
+
+class _LRUCache:
+    """Small in-process LRU for deserialized store objects."""
+    
+    def __init__(self, maxsize: int = 1024):
+        self.maxsize = maxsize
+        self._data: OrderedDict = OrderedDict()
+    
+    def get(self, key):
+        try:
+            self._data.move_to_end(key)
+            return self._data[key]
+        except KeyError:
+            return None
+    
+    def put(self, key, value) -> None:
+        self._data[key] = value
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+    
+    def pop(self, key) -> None:
+        self._data.pop(key, None)
 
 class SimpleSQLiteStore(Store[Any]):
     """Simple SQLite store for development."""
     
     def __init__(self, db_path: str = "pet_chat.db"):
         self.db_path = db_path
-        self._create_tables()
+        # A single long-lived connection keeps SQLite's page cache warm across
+        # requests instead of re-opening the database file on every call.
+        self._conn = self._create_connection()
+        self._lock = asyncio.Lock()
+        # Stored JSON of threads by thread id, item (type, data) rows by thread id ->
+        # item id, and item page rows by thread id -> (after, limit, order). Hits skip
+        # the lock, worker thread and query; values are immutable and decoded per call,
+        # so every caller gets its own objects and mutating them can't touch the cache.
+        # This process is the only writer, so entries are updated/dropped on every write.
+        self._thread_cache = _LRUCache(1024)
+        self._item_cache = _LRUCache(1024)
+        self._page_cache = _LRUCache(1024)
+        # Last JSON bytes stored per item id, so unchanged re-saves can be skipped
+        self._stored_item_data = _LRUCache(1024)
+        # Item writes of threads with a turn in progress, held in memory and written in
+        # one transaction when the turn ends: thread id -> item id -> (is_new, row)
+        self._buffered_threads: set[str] = set()
+        self._pending_items: dict[str, dict[str, tuple]] = {}
+        _init_schema(self._conn, self.db_path)
     
     def _create_connection(self):
-        return sqlite3.connect(self.db_path)
-    
-    def _create_tables(self):
-        with self._create_connection() as conn:
-            conn.execute("""
-                CREATE TABLE IF NOT EXISTS threads (
-                    id TEXT PRIMARY KEY,
-                    created_at TEXT NOT NULL,
-                    data TEXT NOT NULL
-                )
-            """)
-            conn.execute("""
-                CREATE TABLE IF NOT EXISTS items (
-                    id TEXT PRIMARY KEY,
-                    thread_id TEXT NOT NULL,
-                    created_at TEXT NOT NULL,
-                    data TEXT NOT NULL
-                )
-            """)
-            conn.commit()
+        return _connect(self.db_path)
+    
+    def close(self) -> None:
+        """Refresh planner statistics and close the connection."""
+        _close(self._conn)
     
     def generate_thread_id(self, context: Any) -> str:
-        return f"cthr_{uuid.uuid4().hex[:8]}"
+        return _sortable_id("cthr")
     
     def generate_item_id(self, item_type: str, thread: ThreadMetadata, context: Any) -> str:
-        return f"cti_{uuid.uuid4().hex[:8]}"
+        return _sortable_id("cti")
+    
+    async def _run(self, fn, *args):
+        """Run a blocking SQLite call on a worker thread, one at a time."""
+        async with self._lock:
+            return await asyncio.to_thread(fn, *args)
+    
+    def begin_item_buffer(self, thread_id: str) -> None:
+        """Hold this thread's item adds/saves in memory until flush_item_buffer."""
+        self._buffered_threads.add(thread_id)
+    
+    async def flush_item_buffer(self, thread_id: str) -> None:
+        """Stop buffering the thread and write its held items in one transaction."""
+        self._buffered_threads.discard(thread_id)
+        await self._flush_items(thread_id)
+    
+    async def _flush_items(self, thread_id: str) -> None:
+        # Reads and deletes of a thread call this first, so they never miss a held write
+        pending = self._pending_items.pop(thread_id, None)
+        if pending:
+            await self._run(self._sync_write_items, thread_id, pending)
+    
+    def _sync_write_items(self, thread_id: str, pending: dict) -> None:
+        inserts = [row for is_new, row in pending.values() if is_new]
+        updates = [(row[4], row[0], thread_id) for is_new, row in pending.values() if not is_new]
+        conn = self._conn
+        # One BEGIN/COMMIT (one fsync) for the whole turn instead of one per item
+        conn.execute("BEGIN")
+        try:
+            inserted_all = True
+            if inserts:
+                # Same outcome as add_thread_item's duplicate handling: the first copy wins
+                before = conn.total_changes
+                conn.executemany(
+                    "INSERT INTO items (id, thread_id, type, created_at, data) VALUES (?, ?, ?, ?, ?)"
+                    " ON CONFLICT(id) DO NOTHING",
+                    inserts
+                )
+                inserted_all = conn.total_changes - before == len(inserts)
+                if not inserted_all:
+                    logger.warning(f"Skipped {len(inserts) - (conn.total_changes - before)} duplicate item inserts")
+            if updates:
+                conn.executemany("UPDATE items SET data = ? WHERE id = ? AND thread_id = ?", updates)
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        self._page_cache.pop(thread_id)
+        items = self._item_cache.get(thread_id)
+        for item_id, (is_new, row) in pending.items():
+            if is_new and not inserted_all:
+                # Can't tell which row was the duplicate, so don't vouch for any stored bytes
+                self._stored_item_data.pop(item_id)
+            else:
+                self._stored_item_data.put(item_id, row[4])
+            if items is not None:
+                items.pop(item_id, None)
+    
+    @staticmethod
+    def _item_row(thread_id: str, item: Any) -> tuple:
+        # Items are kept as raw JSON bytes (a BLOB), so neither side pays a str round trip
+        data = item.__pydantic_serializer__.to_json(item)
+        return (item.id, thread_id, item.type, item.created_at.isoformat(), data)
+    
+    def _buffer_item(self, thread_id: str, item: Any, is_new: bool) -> None:
+        row = self._item_row(thread_id, item)
+        data = row[4]
+        pending = self._pending_items.setdefault(thread_id, {})
+        held = pending.get(item.id)
+        if held is not None:
+            if is_new:
+                logger.warning(f"Item {item.id} already exists, skipping duplicate insert")
+                return
+            # A save of an item added this turn just replaces the row it will insert
+            is_new = held[0]
+        elif not is_new and self._stored_item_data.get(item.id) == data:
+            return
+        pending[item.id] = (is_new, row)
+        self._page_cache.pop(thread_id)
+        items = self._item_cache.get(thread_id)
+        if items is not None:
+            items.pop(item.id, None)
+    
+    def _sync_load_thread(self, thread_id: str) -> ThreadMetadata:
+        cursor = self._conn.execute("SELECT data FROM threads WHERE id = ?", (thread_id,)).fetchone()
+        if cursor is None:
+            raise Exception(f"Thread {thread_id} not found")
+        self._thread_cache.put(thread_id, cursor[0])
+        return ThreadMetadata.model_validate_json(cursor[0])
     
     async def load_thread(self, thread_id: str, context: Any) -> ThreadMetadata:
-        with self._create_connection() as conn:
-            cursor = conn.execute("SELECT data FROM threads WHERE id = ?", (thread_id,)).fetchone()
-            if cursor is None:
-                raise Exception(f"Thread {thread_id} not found")
-            data = json.loads(cursor[0])
-            return ThreadMetadata(**data)
+        data = self._thread_cache.get(thread_id)
+        if data is not None:
+            return ThreadMetadata.model_validate_json(data)
+        return await self._run(self._sync_load_thread, thread_id)
+    
+    def _sync_save_thread(self, thread: ThreadMetadata) -> None:
+        # pydantic's serializer writes JSON bytes (datetimes included) without a dict round
+        # trip; like items they are stored as a BLOB, skipping the str encode/decode
+        data = thread.__pydantic_serializer__.to_json(thread)
+        self._conn.execute(
+            "INSERT OR REPLACE INTO threads (id, created_at, data) VALUES (?, ?, ?)",
+            (thread.id, thread.created_at.isoformat(), data)
+        )
+        self._thread_cache.put(thread.id, data)
     
     async def save_thread(self, thread: ThreadMetadata, context: Any) -> None:
-        with self._create_connection() as conn:
-            # Use model_dump with mode='json' to handle datetime serialization
-            data = json.dumps(thread.model_dump(mode='json'))
-            conn.execute(
-                "INSERT OR REPLACE INTO threads (id, created_at, data) VALUES (?, ?, ?)",
-                (thread.id, thread.created_at.isoformat(), data)
-            )
-            conn.commit()
+        await self._run(self._sync_save_thread, thread)
+    
+    def _sync_load_thread_items(self, thread_id: str, after: str | None, limit: int, order: str):
+        direction = "desc" if order.lower() == "desc" else "asc"
+        query = _ITEM_PAGE_SQL[(direction, bool(after))]
+        # Fetch one row past the page to learn whether there is more
+        params = (thread_id, after, limit + 1) if after else (thread_id, limit + 1)
+        
+        rows = self._conn.execute(query, params).fetchall()
+        has_more = len(rows) > limit
+        rows = tuple(rows[:limit])
+        next_after = rows[-1][0] if has_more else None
+        
+        pages = self._page_cache.get(thread_id)
+        if pages is None:
+            pages = {}
+            self._page_cache.put(thread_id, pages)
+        pages[(after, limit, order)] = (rows, has_more, next_after)
+        return Page(data=self._decode_items(rows), has_more=has_more, after=next_after)
+    
+    @staticmethod
+    def _decode_items(rows) -> list:
+        """Decode (id, type, data) rows into ThreadItems."""
+        if not rows:
+            return []
+        # Decode the whole page in one pydantic-core call: splice the stored JSON
+        # documents into a single array and validate it against the ThreadItem union
+        payload = b"[" + b",".join(
+            data if isinstance(data, bytes) else data.encode() for _, _, data in rows
+        ) + b"]"
+        try:
+            return _ITEM_LIST_ADAPTER.validate_json(payload)
+        except ValidationError:
+            pass
+        # Some row has a type the union doesn't know; pick the ThreadItem subclass from
+        # the type column per row instead (unknown types fall back to UserMessageItem)
+        return [
+            _ITEM_TYPE_MAP.get(item_type, UserMessageItem).model_validate_json(data)
+            for _, item_type, data in rows
+        ]
+    
+    def _sync_has_items_besides(self, thread_id: str, item_id: str) -> bool:
+        row = self._conn.execute(
+            "SELECT 1 FROM items WHERE thread_id = ? AND id != ? LIMIT 1",
+            (thread_id, item_id)
+        ).fetchone()
+        return row is not None
+    
+    async def has_items_besides(self, thread_id: str, item_id: str, context: Any) -> bool:
+        """Check whether a thread has any item other than item_id, without loading items."""
+        await self._flush_items(thread_id)
+        return await self._run(self._sync_has_items_besides, thread_id, item_id)
     
     async def load_thread_items(self, thread_id: str, after: str | None, limit: int, order: str, context: Any):
-        with self._create_connection() as conn:
-            query = "SELECT data FROM items WHERE thread_id = ?"
-            params = [thread_id]
-            if after:
-                query += " AND id > ?"
-                params.append(after)
-            query += f" ORDER BY id {order} LIMIT ?"
-            params.append(limit)
-            
-            cursor = conn.execute(query, params)
-            items = []
-            for row in cursor:
-                data = json.loads(row[0])
-                # Create the appropriate ThreadItem subclass based on type
-                item_type = data.get("type")
-                if item_type == "user_message":
-                    from chatkit.types import UserMessageItem
-                    items.append(UserMessageItem(**data))
-                elif item_type == "assistant_message":
-                    from chatkit.types import AssistantMessageItem
-                    items.append(AssistantMessageItem(**data))
-                elif item_type == "client_tool_call":
-                    from chatkit.types import ClientToolCallItem
-                    items.append(ClientToolCallItem(**data))
-                elif item_type == "widget":
-                    from chatkit.types import WidgetItem
-                    items.append(WidgetItem(**data))
-                elif item_type == "workflow":
-                    from chatkit.types import WorkflowItem
-                    items.append(WorkflowItem(**data))
-                elif item_type == "task":
-                    from chatkit.types import TaskItem
-                    items.append(TaskItem(**data))
-                elif item_type == "hidden_context":
-                    from chatkit.types import HiddenContextItem
-                    items.append(HiddenContextItem(**data))
-                elif item_type == "end_of_turn":
-                    from chatkit.types import EndOfTurnItem
-                    items.append(EndOfTurnItem(**data))
-                else:
-                    # Fallback to UserMessageItem for unknown types
-                    from chatkit.types import UserMessageItem
-                    items.append(UserMessageItem(**data))
-            
-            from chatkit.types import Page
-            return Page(data=items, has_more=False, after=None)
+        await self._flush_items(thread_id)
+        pages = self._page_cache.get(thread_id)
+        if pages is not None:
+            cached = pages.get((after, limit, order))
+            if cached is not None:
+                rows, has_more, next_after = cached
+                return Page(data=self._decode_items(rows), has_more=has_more, after=next_after)
+        return await self._run(self._sync_load_thread_items, thread_id, after, limit, order)
+    
+    def _sync_save_attachment(self, attachment: Any) -> None:
+        # Normalize dicts and attachment models to one dict up front
+        if isinstance(attachment, dict):
+            fields = attachment
+        else:
+            fields = {
+                "id": attachment.id,
+                "name": attachment.name,
+                "mime_type": attachment.mime_type,
+                "size": getattr(attachment, "size", 0),
+                # ImageAttachment/FileAttachment carry no payload; the attachment store holds it
+                "data": getattr(attachment, "data", ""),
+            }
+        
+        self._conn.execute(
+            "INSERT OR REPLACE INTO attachments (id, name, mime_type, size, data, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                fields.get("id"),
+                fields.get("name"),
+                fields.get("mime_type"),
+                fields.get("size", 0),
+                fields.get("data", ""),
+                datetime.now().isoformat()
+            )
+        )
     
     async def save_attachment(self, attachment: Any, context: Any) -> None:
         """Save attachment data to database."""
-        with self._create_connection() as conn:
-            # Extract base64 data from attachment
-            if hasattr(attachment, 'data'):
-                data = attachment.data
-            elif isinstance(attachment, dict) and 'data' in attachment:
-                data = attachment['data']
-            else:
-                # For ImageAttachment/FileAttachment objects, we need to get the actual data
-                # This will be handled by the attachment store
-                data = ""
-            
-            conn.execute(
-                "INSERT OR REPLACE INTO attachments (id, name, mime_type, size, data, created_at) VALUES (?, ?, ?, ?, ?, ?)",
-                (
-                    attachment.id if hasattr(attachment, 'id') else attachment.get('id'),
-                    attachment.name if hasattr(attachment, 'name') else attachment.get('name'),
-                    attachment.mime_type if hasattr(attachment, 'mime_type') else attachment.get('mime_type'),
-                    attachment.size if hasattr(attachment, 'size') else attachment.get('size', 0),
-                    data,
-                    datetime.now().isoformat()
+        await self._run(self._sync_save_attachment, attachment)
+    
+    def _sync_load_attachment(self, attachment_id: str):
+        conn = self._conn
+        # Debug: Show all attachments in database (a full table scan, so only when debugging)
+        if logger.isEnabledFor(logging.DEBUG):
+            all_attachments = conn.execute("SELECT id, name FROM attachments").fetchall()
+            logger.debug("All attachments in database: %s", all_attachments)
+        
+        # Metadata only: length(data) comes from the record header, so the payload
+        # is read (and streamed) only when an image preview actually needs it
+        cursor = conn.cursor()
+        cursor.row_factory = sqlite3.Row
+        row = cursor.execute(
+            "SELECT id, name, mime_type, length(data) AS data_length FROM attachments WHERE id = ?",
+            (attachment_id,)
+        ).fetchone()
+        if row is None:
+            logger.error(f"Attachment {attachment_id} not found in database")
+            raise Exception(f"Attachment {attachment_id} not found")
+        
+        logger.info(f"Found attachment: {row['id']} - {row['name']}")
+        mime_type = row["mime_type"]
+        
+        # Return proper ChatKit attachment object with type discriminator
+        if mime_type and mime_type.startswith("image/"):
+            return ImageAttachment(
+                id=row["id"],
+                name=row["name"],
+                mime_type=mime_type,
+                upload_url=None,
+                preview_url=(
+                    f"data:{mime_type};base64,{_read_attachment_base64(conn, attachment_id)}"
+                    if row["data_length"] else None
                 )
             )
-            conn.commit()
+        else:
+            return FileAttachment(
+                id=row["id"],
+                name=row["name"],
+                mime_type=mime_type,
+                upload_url=None
+            )
     
     async def load_attachment(self, attachment_id: str, context: Any):
         """Load attachment from database."""
         logger.info(f"Loading attachment with ID: {attachment_id}")
-        
-        with self._create_connection() as conn:
-            # Debug: Show all attachments in database
-            all_attachments = conn.execute("SELECT id, name FROM attachments").fetchall()
-            logger.info(f"All attachments in database: {all_attachments}")
-            
-            cursor = conn.execute("SELECT * FROM attachments WHERE id = ?", (attachment_id,)).fetchone()
-            if cursor is None:
-                logger.error(f"Attachment {attachment_id} not found in database")
-                raise Exception(f"Attachment {attachment_id} not found")
-            
-            logger.info(f"Found attachment: {cursor[0]} - {cursor[1]}")
-            
-            # Extract data from database
-            id_val = cursor[0]
-            name = cursor[1]
-            mime_type = cursor[2]
-            size = cursor[3]
-            data = cursor[4]
-            created_at = cursor[5]
-            
-            # Return proper ChatKit attachment object with type discriminator
-            from chatkit.types import ImageAttachment, FileAttachment
-            
-            if mime_type and mime_type.startswith("image/"):
-                return ImageAttachment(
-                    id=id_val,
-                    name=name,
-                    mime_type=mime_type,
-                    upload_url=None,
-                    preview_url=f"data:{mime_type};base64,{data}" if data else None
-                )
-            else:
-                return FileAttachment(
-                    id=id_val,
-                    name=name,
-                    mime_type=mime_type,
-                    upload_url=None
-                )
+        return await self._run(self._sync_load_attachment, attachment_id)
+    
+    def _sync_load_attachment_data(self, attachment_id: str) -> str:
+        return _read_attachment_base64(self._conn, attachment_id)
+    
+    async def load_attachment_data(self, attachment_id: str) -> str:
+        """Load only the base64 payload of an attachment ("" if missing)."""
+        return await self._run(self._sync_load_attachment_data, attachment_id)
+    
+    def _sync_load_attachments_data(self, attachment_ids: list[str]) -> dict[str, str]:
+        return {aid: _read_attachment_base64(self._conn, aid) for aid in attachment_ids}
+    
+    async def load_attachments_data(self, attachment_ids: list[str]) -> dict[str, str]:
+        """load_attachment_data for several attachments in a single worker-thread call."""
+        return await self._run(self._sync_load_attachments_data, attachment_ids)
+    
+    def _sync_delete_attachment(self, attachment_id: str) -> None:
+        self._conn.execute("DELETE FROM attachments WHERE id = ?", (attachment_id,))
     
     async def delete_attachment(self, attachment_id: str, context: Any) -> None:
         """Delete attachment from database."""
-        with self._create_connection() as conn:
-            conn.execute("DELETE FROM attachments WHERE id = ?", (attachment_id,))
-            conn.commit()
+        await self._run(self._sync_delete_attachment, attachment_id)
+    
+    def _sync_load_threads(self, limit: int, after: str | None, order: str):
+        direction = "desc" if order.lower() == "desc" else "asc"
+        query = _THREAD_PAGE_SQL[(direction, bool(after))]
+        params = (after, limit + 1) if after else (limit + 1,)
+        
+        rows = self._conn.execute(query, params).fetchall()
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        # Same one-call page decode as load_thread_items
+        threads = _THREAD_LIST_ADAPTER.validate_json(
+            b"[" + b",".join(
+                data if isinstance(data, bytes) else data.encode() for _, data in rows
+            ) + b"]"
+        ) if rows else []
+        
+        return Page(data=threads, has_more=has_more, after=rows[-1][0] if has_more else None)
     
     async def load_threads(self, limit: int, after: str | None, order: str, context: Any):
-        with self._create_connection() as conn:
-            query = "SELECT data FROM threads"
-            params = []
-            if after:
-                query += " WHERE id > ?"
-                params.append(after)
-            query += f" ORDER BY id {order} LIMIT ?"
-            params.append(limit)
-            
-            cursor = conn.execute(query, params)
-            threads = []
-            for row in cursor:
-                data = json.loads(row[0])
-                threads.append(ThreadMetadata(**data))
-            
-            from chatkit.types import Page
-            return Page(data=threads, has_more=False, after=None)
+        return await self._run(self._sync_load_threads, limit, after, order)
+    
+    def _sync_add_thread_item(self, thread_id: str, item: Any) -> None:
+        row = self._item_row(thread_id, item)
+        try:
+            self._conn.execute(
+                "INSERT INTO items (id, thread_id, type, created_at, data) VALUES (?, ?, ?, ?, ?)",
+                row
+            )
+            self._page_cache.pop(thread_id)
+            self._stored_item_data.put(item.id, row[4])
+        except sqlite3.IntegrityError as e:
+            if "UNIQUE constraint failed" in str(e):
+                logger.warning(f"Item {item.id} already exists, skipping duplicate insert")
+                # This is expected behavior - ChatKit shouldn't add duplicates
+                # but if it does, we gracefully handle it
+            else:
+                raise
     
     async def add_thread_item(self, thread_id: str, item: Any, context: Any) -> None:
-        with self._create_connection() as conn:
-            data = json.dumps(item.model_dump(mode='json'))
-            try:
-                conn.execute(
-                    "INSERT INTO items (id, thread_id, created_at, data) VALUES (?, ?, ?, ?)",
-                    (item.id, thread_id, item.created_at.isoformat(), data)
-                )
-                conn.commit()
-            except sqlite3.IntegrityError as e:
-                if "UNIQUE constraint failed" in str(e):
-                    logger.warning(f"Item {item.id} already exists, skipping duplicate insert")
-                    # This is expected behavior - ChatKit shouldn't add duplicates
-                    # but if it does, we gracefully handle it
-                else:
-                    raise
+        if thread_id in self._buffered_threads:
+            self._buffer_item(thread_id, item, True)
+            return
+        await self._run(self._sync_add_thread_item, thread_id, item)
+    
+    def _sync_save_item(self, thread_id: str, item: Any) -> None:
+        data = item.__pydantic_serializer__.to_json(item)
+        # Streaming re-saves the same item repeatedly; skip the write when nothing changed
+        if self._stored_item_data.get(item.id) == data:
+            return
+        self._conn.execute(
+            "UPDATE items SET data = ? WHERE id = ? AND thread_id = ?",
+            (data, item.id, thread_id)
+        )
+        self._stored_item_data.put(item.id, data)
+        self._page_cache.pop(thread_id)
+        items = self._item_cache.get(thread_id)
+        if items is not None:
+            items.pop(item.id, None)
+    
+    async def add_thread_items(self, thread_id: str, items: list, context: Any) -> None:
+        """Insert several items with one executemany and a single commit."""
+        if thread_id in self._buffered_threads:
+            for item in items:
+                self._buffer_item(thread_id, item, True)
+            return
+        pending: dict[str, tuple] = {}
+        for item in items:
+            pending.setdefault(item.id, (True, self._item_row(thread_id, item)))
+        if pending:
+            await self._run(self._sync_write_items, thread_id, pending)
     
     async def save_item(self, thread_id: str, item: Any, context: Any) -> None:
-        with self._create_connection() as conn:
-            data = json.dumps(item.model_dump(mode='json'))
-            conn.execute(
-                "UPDATE items SET data = ? WHERE id = ? AND thread_id = ?",
-                (data, item.id, thread_id)
-            )
-            conn.commit()
+        if thread_id in self._buffered_threads:
+            self._buffer_item(thread_id, item, False)
+            return
+        await self._run(self._sync_save_item, thread_id, item)
+    
+    def _sync_load_item(self, thread_id: str, item_id: str):
+        cursor = self._conn.execute(
+            "SELECT type, data FROM items WHERE id = ? AND thread_id = ?",
+            (item_id, thread_id)
+        ).fetchone()
+        if cursor is None:
+            raise Exception(f"Item {item_id} not found")
+        item_type, data = cursor
+        self._stored_item_data.put(item_id, data)
+        items = self._item_cache.get(thread_id)
+        if items is None:
+            items = {}
+            self._item_cache.put(thread_id, items)
+        items[item_id] = (item_type, data)
+        return self._decode_item(item_type, data)
+    
+    @staticmethod
+    def _decode_item(item_type: str, data):
+        # Create the appropriate ThreadItem subclass based on type
+        cls = _ITEM_TYPE_MAP.get(item_type, UserMessageItem)
+        return cls.model_validate_json(data)
     
     async def load_item(self, thread_id: str, item_id: str, context: Any):
-        with self._create_connection() as conn:
-            cursor = conn.execute(
-                "SELECT data FROM items WHERE id = ? AND thread_id = ?",
-                (item_id, thread_id)
-            ).fetchone()
-            if cursor is None:
-                raise Exception(f"Item {item_id} not found")
-            data = json.loads(cursor[0])
-            
-            # Create the appropriate ThreadItem subclass based on type
-            item_type = data.get("type")
-            if item_type == "user_message":
-                from chatkit.types import UserMessageItem
-                return UserMessageItem(**data)
-            elif item_type == "assistant_message":
-                from chatkit.types import AssistantMessageItem
-                return AssistantMessageItem(**data)
-            elif item_type == "client_tool_call":
-                from chatkit.types import ClientToolCallItem
-                return ClientToolCallItem(**data)
-            elif item_type == "widget":
-                from chatkit.types import WidgetItem
-                return WidgetItem(**data)
-            elif item_type == "workflow":
-                from chatkit.types import WorkflowItem
-                return WorkflowItem(**data)
-            elif item_type == "task":
-                from chatkit.types import TaskItem
-                return TaskItem(**data)
-            elif item_type == "hidden_context":
-                from chatkit.types import HiddenContextItem
-                return HiddenContextItem(**data)
-            elif item_type == "end_of_turn":
-                from chatkit.types import EndOfTurnItem
-                return EndOfTurnItem(**data)
-            else:
-                # Fallback to UserMessageItem for unknown types
-                from chatkit.types import UserMessageItem
-                return UserMessageItem(**data)
+        await self._flush_items(thread_id)
+        items = self._item_cache.get(thread_id)
+        if items is not None:
+            row = items.get(item_id)
+            if row is not None:
+                return self._decode_item(*row)
+        return await self._run(self._sync_load_item, thread_id, item_id)
     
-    async def delete_thread(self, thread_id: str, context: Any) -> None:
-        with self._create_connection() as conn:
+    def _sync_delete_thread(self, thread_id: str) -> None:
+        conn = self._conn
+        # Both deletes in one short transaction, opened and closed within this call
+        conn.execute("BEGIN")
+        try:
+            item_ids = [row[0] for row in conn.execute("SELECT id FROM items WHERE thread_id = ?", (thread_id,))]
             conn.execute("DELETE FROM threads WHERE id = ?", (thread_id,))
             conn.execute("DELETE FROM items WHERE thread_id = ?", (thread_id,))
-            conn.commit()
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        self._thread_cache.pop(thread_id)
+        self._item_cache.pop(thread_id)
+        self._page_cache.pop(thread_id)
+        for item_id in item_ids:
+            self._stored_item_data.pop(item_id)
+    
+    async def delete_thread(self, thread_id: str, context: Any) -> None:
+        # Held writes of a deleted thread have nothing left to write to
+        self._buffered_threads.discard(thread_id)
+        self._pending_items.pop(thread_id, None)
+        await self._run(self._sync_delete_thread, thread_id)
+    
+    def _sync_delete_thread_item(self, thread_id: str, item_id: str) -> None:
+        self._conn.execute(
+            "DELETE FROM items WHERE id = ? AND thread_id = ?",
+            (item_id, thread_id)
+        )
+        self._stored_item_data.pop(item_id)
+        self._page_cache.pop(thread_id)
+        items = self._item_cache.get(thread_id)
+        if items is not None:
+            items.pop(item_id, None)
     
     async def delete_thread_item(self, thread_id: str, item_id: str, context: Any) -> None:
-        with self._create_connection() as conn:
-            conn.execute(
-                "DELETE FROM items WHERE id = ? AND thread_id = ?",
-                (item_id, thread_id)
-            )
-            conn.commit()
+        await self._flush_items(thread_id)
+        await self._run(self._sync_delete_thread_item, thread_id, item_id)
 
 # =============================================================================
 # SIMPLE SQLITE ATTACHMENT STORE
@@ -412,27 +813,32 @@ class SimpleSQLiteAttachmentStore(AttachmentStore[Any]):
     
     def __init__(self, db_path: str = "pet_chat.db"):
         self.db_path = db_path
-        self._create_tables()
+        # Same as SimpleSQLiteStore: one long-lived autocommit connection instead of
+        # connecting (and dropping the page cache) on every call
+        self._conn = self._create_connection()
+        self._lock = asyncio.Lock()
+        _init_schema(self._conn, self.db_path)
     
     def _create_connection(self):
-        return sqlite3.connect(self.db_path)
-    
-    def _create_tables(self):
-        with self._create_connection() as conn:
-            conn.execute("""
-                CREATE TABLE IF NOT EXISTS attachments (
-                    id TEXT PRIMARY KEY,
-                    name TEXT NOT NULL,
-                    mime_type TEXT NOT NULL,
-                    size INTEGER NOT NULL,
-                    data TEXT NOT NULL,
-                    created_at TEXT NOT NULL
-                )
-            """)
-            conn.commit()
+        return _connect(self.db_path)
+    
+    async def _run(self, fn, *args):
+        """Run a blocking SQLite call on a worker thread, one at a time."""
+        async with self._lock:
+            return await asyncio.to_thread(fn, *args)
+    
+    def close(self) -> None:
+        """Refresh planner statistics and close the connection."""
+        _close(self._conn)
     
     def generate_attachment_id(self, mime_type: str, context: Any) -> str:
-        return f"atc_{uuid.uuid4().hex[:8]}"
+        return f"atc_{secrets.token_hex(4)}"
+    
+    def _sync_create_attachment(self, attachment_id: str, input: AttachmentCreateParams) -> None:
+        self._conn.execute(
+            "INSERT INTO attachments (id, name, mime_type, size, data, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+            (attachment_id, input.name, input.mime_type, input.size, b"", datetime.now().isoformat())
+        )
     
     async def create_attachment(self, input: AttachmentCreateParams, context: Any) -> Attachment:
         """Create attachment metadata and return attachment object."""
@@ -440,13 +846,8 @@ class SimpleSQLiteAttachmentStore(AttachmentStore[Any]):
         logger.info(f"Creating attachment with ID: {attachment_id}")
 
         # Create database record
-        with self._create_connection() as conn:
-            conn.execute(
-                "INSERT INTO attachments (id, name, mime_type, size, data, created_at) VALUES (?, ?, ?, ?, ?, ?)",
-                (attachment_id, input.name, input.mime_type, input.size, "", datetime.now().isoformat())
-            )
-            conn.commit()
-            logger.info(f"Stored attachment in database with ID: {attachment_id}")
+        await self._run(self._sync_create_attachment, attachment_id, input)
+        logger.info(f"Stored attachment in database with ID: {attachment_id}")
         
         if input.mime_type.startswith("image/"):
             return ImageAttachment(
@@ -464,48 +865,88 @@ class SimpleSQLiteAttachmentStore(AttachmentStore[Any]):
                 upload_url=None  # Direct upload
             )
     
+    def _sync_upload_attachment_data(self, attachment_id: str, data: bytes) -> None:
+        # Raw bytes as a BLOB; base64 only happens when a data URL is built on read
+        self._conn.execute(
+            "UPDATE attachments SET data = ? WHERE id = ?",
+            (data, attachment_id)
+        )
+    
     async def upload_attachment_data(self, attachment_id: str, data: bytes, context: Any) -> None:
         """Store the actual attachment data."""
-        import base64
-        base64_data = base64.b64encode(data).decode('utf-8')
-        
-        with self._create_connection() as conn:
-            conn.execute(
-                "UPDATE attachments SET data = ? WHERE id = ?",
-                (base64_data, attachment_id)
-            )
-            conn.commit()
+        await self._run(self._sync_upload_attachment_data, attachment_id, data)
+    
+    def _sync_upload_attachment_file(self, attachment_id: str, fileobj, size: int) -> None:
+        conn = self._conn
+        conn.execute("BEGIN")
+        try:
+            # Reserve the BLOB at its final size, then fill it in place chunk by chunk
+            conn.execute("UPDATE attachments SET data = zeroblob(?) WHERE id = ?", (size, attachment_id))
+            row = conn.execute("SELECT rowid FROM attachments WHERE id = ?", (attachment_id,)).fetchone()
+            if row is not None and size:
+                with conn.blobopen("attachments", "data", row[0]) as blob:
+                    while chunk := fileobj.read(_BLOB_CHUNK):
+                        blob.write(chunk)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+    
+    async def upload_attachment_file(self, attachment_id: str, fileobj, size: int, context: Any) -> None:
+        """Store attachment data read from a file object of known size, without buffering it whole."""
+        await self._run(self._sync_upload_attachment_file, attachment_id, fileobj, size)
+    
+    def _sync_delete_attachment(self, attachment_id: str) -> None:
+        self._conn.execute("DELETE FROM attachments WHERE id = ?", (attachment_id,))
     
     async def delete_attachment(self, attachment_id: str, context: Any) -> None:
         """Delete attachment from database."""
-        with self._create_connection() as conn:
-            conn.execute("DELETE FROM attachments WHERE id = ?", (attachment_id,))
-            conn.commit()
+        await self._run(self._sync_delete_attachment, attachment_id)
 
 # =============================================================================
 # PET ASSISTANT THREAD ITEM CONVERTER
 # =============================================================================
 
+# Attachment payloads prefetched for the user message currently being converted.
+# A ContextVar rather than an attribute: one converter serves concurrent requests.
+_prefetched_attachment_data: ContextVar[dict[str, str]] = ContextVar("_prefetched_attachment_data", default={})
+
+
 class PetAssistantThreadItemConverter(ThreadItemConverter):
-    """Custom converter for pet assistant that handles image attachments."""
+    """Custom converter for pet assistant that handles image attachments.
+    
+    Attachment payloads are read with SimpleSQLiteStore.load_attachment(s)_data; other
+    Store implementations get the base converter's attachment handling.
+    """
     
     def __init__(self, store: Store):
         self.store = store
     
+    async def user_message_to_input(self, item: UserMessageItem, is_last_message: bool = True):
+        """Fetch all of the message's attachment payloads in one store call, then convert."""
+        if len(item.attachments) < 2 or not hasattr(self.store, "load_attachments_data"):
+            return await super().user_message_to_input(item, is_last_message)
+        token = _prefetched_attachment_data.set(
+            await self.store.load_attachments_data([a.id for a in item.attachments])
+        )
+        try:
+            return await super().user_message_to_input(item, is_last_message)
+        finally:
+            _prefetched_attachment_data.reset(token)
+    
     async def attachment_to_message_content(self, attachment: Attachment):
         """Convert attachment to Agent SDK input format using ChatKit's native approach."""
         # Get the raw attachment data from our store
-        with self.store._create_connection() as conn:
-            cursor = conn.execute("SELECT data FROM attachments WHERE id = ?", (attachment.id,)).fetchone()
-            base64_data = cursor[0] if cursor else ""
+        base64_data = _prefetched_attachment_data.get().get(attachment.id)
+        if base64_data is None:
+            if not hasattr(self.store, "load_attachment_data"):
+                return await super().attachment_to_message_content(attachment)
+            base64_data = await self.store.load_attachment_data(attachment.id)
         
         # Create data URL for the attachment
         data_url = f"data:{attachment.mime_type};base64,{base64_data}"
         
         # Use proper ChatKit/Agent SDK types
-        from openai.types.responses.response_input_image_param import ResponseInputImageParam
-        from openai.types.responses.response_input_file_param import ResponseInputFileParam
-        
         if isinstance(attachment, ImageAttachment):
             return ResponseInputImageParam(
                 type="input_image",
@@ -524,6 +965,25 @@ class PetAssistantThreadItemConverter(ThreadItemConverter):
 # FASTAPI APPLICATION
 # =============================================================================
 
+# Keep proxies (nginx in particular) from buffering SSE chunks, which delays first token
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "X-Accel-Buffering": "no",
+}
+
+
+def _request_context(request: Request) -> dict:
+    """Build the ChatKit request context from headers.
+    
+    Stays a plain dict: pet_agent's tools read it with .get().
+    """
+    headers = request.headers
+    return {
+        "user_id": headers.get("user-id"),
+        "session_id": headers.get("session-id"),
+        "username": headers.get("username", "benno"),  # Default to "benno"
+    }
+
 def create_app(data_store: Store) -> FastAPI:
     """Create FastAPI app with ChatKit server."""
     logger.info("Creating FastAPI application")
@@ -547,6 +1007,14 @@ def create_app(data_store: Store) -> FastAPI:
     attachment_store = SimpleSQLiteAttachmentStore("pet_chat.db")
     chatkit_server = PetChatKitServer(data_store, attachment_store)
     
+    @app.on_event("shutdown")
+    async def close_stores():
+        """Close SQLite connections and the pooled OpenSearch client on shutdown."""
+        attachment_store.close()
+        if isinstance(data_store, SimpleSQLiteStore):
+            data_store.close()
+        await close_search_client()
+    
     @app.options("/chatkit")
     async def chatkit_options():
         """Handle CORS preflight requests."""
@@ -557,19 +1025,8 @@ def create_app(data_store: Store) -> FastAPI:
         """ChatKit endpoint following official documentation pattern."""
         logger.info("Received ChatKit request")
         
-        # Extract context from headers
-        user_id = request.headers.get("user-id")
-        session_id = request.headers.get("session-id")
-        username = request.headers.get("username", "benno")  # Default to "benno"
-        
-        # Create context dictionary
-        context = {
-            "user_id": user_id,
-            "session_id": session_id,
-            "username": username,
-        }
-        
-        logger.info(f"Request context: {context}")
+        context = _request_context(request)
+        logger.info("Request context: %s", context)
         
         try:
             # Use the official ChatKit server.process() method with context
@@ -577,7 +1034,10 @@ def create_app(data_store: Store) -> FastAPI:
             
             if isinstance(result, StreamingResult):
                 logger.info("Returning streaming response")
-                return StreamingResponse(result, media_type="text/event-stream")
+                # ChatKit already yields b"data: <json>\n\n" frames; hand its generator to Starlette
+                # directly rather than through StreamingResult's extra per-event re-yield
+                events = getattr(result, "json_events", result)
+                return StreamingResponse(events, media_type="text/event-stream", headers=SSE_HEADERS)
             else:
                 logger.info("Returning JSON response")
                 return Response(content=result.json, media_type="application/json")
@@ -597,18 +1057,9 @@ def create_app(data_store: Store) -> FastAPI:
         logger.info("Received ChatKit attachment upload request")
         
         # Log all headers for debugging
-        logger.info(f"Request headers: {dict(request.headers)}")
+        logger.debug("Request headers: %s", request.headers)
         
-        # Extract context from headers
-        user_id = request.headers.get("user-id")
-        session_id = request.headers.get("session-id")
-        username = request.headers.get("username", "benno")
-        
-        context = {
-            "user_id": user_id,
-            "session_id": session_id,
-            "username": username,
-        }
+        context = _request_context(request)
         
         try:
             # Check if this is a multipart form upload
@@ -616,8 +1067,7 @@ def create_app(data_store: Store) -> FastAPI:
             if "multipart/form-data" in content_type:
                 # Handle direct file upload
                 form = await request.form()
-                logger.info(f"Form data keys: {list(form.keys())}")
-                logger.info(f"Form data: {dict(form)}")
+                logger.info("Form data keys: %s", list(form.keys()))
                 
                 file = form.get("file")
                 
@@ -625,16 +1075,16 @@ def create_app(data_store: Store) -> FastAPI:
                     raise HTTPException(status_code=400, detail="No file field in form data")
                 
                 # Generate a single attachment ID that we'll use consistently
-                import uuid
-                attachment_id = f"atc_{uuid.uuid4().hex[:8]}"
+                attachment_id = attachment_store.generate_attachment_id(file.content_type or "", context)
                 logger.info(f"Generated attachment ID: {attachment_id}")
                 
-                # Read file data
-                file_data = await file.read()
+                # Size the spooled upload without reading it into memory; the data is
+                # streamed from the spool file into the BLOB below
+                file.file.seek(0, os.SEEK_END)
+                file_size = file.file.tell()
+                file.file.seek(0)
                 
                 # Create attachment metadata
-                from chatkit.types import ImageAttachment, FileAttachment
-                
                 if file.content_type and file.content_type.startswith("image/"):
                     attachment = ImageAttachment(
                         id=attachment_id,
@@ -652,11 +1102,10 @@ def create_app(data_store: Store) -> FastAPI:
                     )
                 
                 # Store attachment metadata and data using the SAME ID
-                from chatkit.types import AttachmentCreateParams
                 create_params = AttachmentCreateParams(
                     name=attachment.name,
                     mime_type=attachment.mime_type,
-                    size=len(file_data)
+                    size=file_size
                 )
                 
                 # Override the attachment store's ID generation to use our ID
@@ -665,13 +1114,14 @@ def create_app(data_store: Store) -> FastAPI:
                 
                 try:
                     await attachment_store.create_attachment(create_params, context)
-                    await attachment_store.upload_attachment_data(attachment_id, file_data, context)
+                    await attachment_store.upload_attachment_file(attachment_id, file.file, file_size, context)
                 finally:
                     # Restore original ID generation method
                     attachment_store.generate_attachment_id = original_generate_id
                 
                 logger.info(f"Successfully uploaded ChatKit attachment {attachment_id}")
-                return attachment.model_dump()
+                # Serialize in pydantic-core instead of FastAPI's jsonable_encoder pass
+                return Response(content=attachment.model_dump_json(), media_type="application/json")
                 
             else:
                 # Handle legacy header-based approach
@@ -683,8 +1133,7 @@ def create_app(data_store: Store) -> FastAPI:
                 )
                 
                 if not attachment_id:
-                    import uuid
-                    attachment_id = f"atc_{uuid.uuid4().hex[:8]}"
+                    attachment_id = attachment_store.generate_attachment_id("", context)
                     logger.info(f"Generated attachment ID: {attachment_id}")
                 
                 file_data = await request.body()
@@ -3,18 +3,31 @@
 
 import os
 import sys
+import socket
+import asyncio
 import json
 import time
 import hashlib
+import heapq
+import threading
+from functools import lru_cache
 from typing import Any, Dict, List, Optional, Tuple
 
 import uvicorn
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+from urllib3.util.retry import Retry
 try:
     # OpenAI SDK for client-side embeddings
     from openai import OpenAI  # type: ignore
 except Exception:
     OpenAI = None  # lazy optional import
+try:
+    # Faster JSON for OpenSearch bodies/responses and tool output; stdlib json otherwise
+    import orjson  # type: ignore
+except Exception:
+    orjson = None
 
 # Allow imports from /mnt/data if you later share business logic there
 UPLOAD_DIR = "/mnt/data"
@@ -27,7 +40,7 @@ from fastmcp.server.auth.providers.jwt import StaticTokenVerifier
 
 from starlette.middleware.cors import CORSMiddleware
 from starlette.middleware.base import BaseHTTPMiddleware
-from starlette.responses import Response, JSONResponse
+from starlette.responses import JSONResponse
 
 # ==============================================================================
 # Helpers
@@ -39,14 +52,28 @@ def env_bool(name: str, default: bool = False) -> bool:
     v = v.strip().lower()
     return v in ("1", "true", "yes", "y", "on")
 
+def _dumps_bytes(obj: Any) -> bytes:
+    """UTF-8 JSON (non-ASCII kept as is); orjson when installed."""
+    if orjson is not None:
+        return orjson.dumps(obj, default=str, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj, ensure_ascii=False, default=str).encode("utf-8")
+
+def _dumps(obj: Any) -> str:
+    if orjson is not None:
+        return orjson.dumps(obj, default=str, option=orjson.OPT_NON_STR_KEYS).decode("utf-8")
+    return json.dumps(obj, ensure_ascii=False, default=str)
+
+def _loads(data: bytes) -> Any:
+    return orjson.loads(data) if orjson is not None else json.loads(data)
+
 def jlog(event: str, **kwargs):
     payload = {"event": event, "ts": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())}
     payload.update(kwargs)
-    print(json.dumps(payload, ensure_ascii=False))
+    print(_dumps(payload))
 
 def _jdump(obj: Any, limit: int = 2000) -> str:
     try:
-        s = json.dumps(obj, ensure_ascii=False, default=str)
+        s = _dumps(obj)
     except Exception:
         s = str(obj)
     return s if len(s) <= limit else s[:limit] + "...[truncated]"
@@ -64,7 +91,15 @@ def _token_forms(tok: str):
     return {t: {"client_id": "client", "scopes": ["tools:call"]} for t in forms if t}
 
 # Client-side text embedding using OpenAI (optional)
-from typing import Optional, List  # ensure types available here
+
+_OPENAI_CLIENT = None
+
+def _openai_client():
+    # Built once and reused so embedding calls keep the SDK's pooled HTTP connections
+    global _OPENAI_CLIENT
+    if _OPENAI_CLIENT is None:
+        _OPENAI_CLIENT = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+    return _OPENAI_CLIENT
 
 def embed_text_with_openai(text: str) -> Optional[List[float]]:
     if not text:
@@ -73,14 +108,33 @@ def embed_text_with_openai(text: str) -> Optional[List[float]]:
         _log_tool("tool.warn", "openai.embedding_unavailable", error="OpenAI SDK not installed")
         return None
     try:
-        client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-        resp = client.embeddings.create(model=OPENAI_EMBED_MODEL, input=text)
+        resp = _openai_client().embeddings.create(model=OPENAI_EMBED_MODEL, input=text)
         # OpenAI 1.x response structure
         return resp.data[0].embedding  # type: ignore[attr-defined]
     except Exception as e:
         _log_tool("tool.warn", "openai.embedding_failed", error=str(e))
         return None
 
+class _EmbeddingMiss(Exception):
+    """Raised inside the cached lookup so failed embeddings are not memoized."""
+
+@lru_cache(maxsize=2048)
+def _embed_cached(text: str) -> Tuple[float, ...]:
+    vec = embed_text_with_openai(text)
+    if not vec:
+        raise _EmbeddingMiss(text)
+    return tuple(vec)
+
+def embed_text_cached(text: str) -> Optional[List[float]]:
+    # Agents often repeat the same embedding_text within a session; skip the OpenAI hop on repeats
+    key = " ".join((text or "").split())
+    if not key:
+        return None
+    try:
+        return list(_embed_cached(key))
+    except _EmbeddingMiss:
+        return None
+
 # ==============================================================================
 # Config (Auth + OpenSearch creds)
 # ==============================================================================
@@ -88,6 +142,7 @@ TOKEN = os.getenv("MCP_TOKEN", "REDACTED")
 DISABLE_AUTH = os.getenv("MCP_DISABLE_AUTH", "0") == "1"
 LOG_BODY_LIMIT = int(os.getenv("LOG_BODY_LIMIT", "4096"))
 LOG_SHOW_TOKENS = os.getenv("LOG_SHOW_TOKENS", "1") == "1"
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "1000"))  # pending request/response log blocks
 
 OS_HOST = os.getenv("OS_HOST", "localhost")
 OS_PORT = int(os.getenv("OS_PORT", "9200"))
@@ -98,6 +153,7 @@ OS_CA_CERT  = os.getenv("OS_CA_CERT")
 OS_INDEX    = os.getenv("OS_INDEX", "products_pets_v3")
 DISABLE_KNN = os.getenv("DISABLE_KNN", "0") == "1"
 OPENAI_EMBED_MODEL = os.getenv("OPENAI_EMBED_MODEL", "text-embedding-3-small")
+TAXO_CACHE_TTL = float(os.getenv("TAXO_CACHE_TTL", "600"))  # seconds; 0 disables
 
 if OS_INSECURE:
     OS_SCHEME = "http"
@@ -107,22 +163,56 @@ else:
     OS_VERIFY = OS_CA_CERT if OS_CA_CERT else True
 
 BASE_URL = f"{OS_SCHEME}://{OS_HOST}:{OS_PORT}"
+_URL_SEARCH = f"{BASE_URL}/{OS_INDEX}/_search"
+_URL_MSEARCH = f"{BASE_URL}/{OS_INDEX}/_msearch"
+_URL_COUNT = f"{BASE_URL}/{OS_INDEX}/_count"
+_URL_MAPPING = f"{BASE_URL}/{OS_INDEX}/_mapping"
 
 def _auth_tuple() -> Optional[Tuple[str, str]]:
     if OS_USER or OS_PASS:
         return (OS_USER, OS_PASS)
     return None
 
+_AUTH = _auth_tuple()  # credentials are fixed at startup
+
+# One pooled keep-alive session for every OpenSearch call, so requests reuse
+# TCP/TLS connections instead of handshaking on each search
+_SESSION = requests.Session()
+_SESSION.auth = _AUTH
+_SESSION.verify = OS_VERIFY
+class _KeepAliveAdapter(HTTPAdapter):
+    """HTTPAdapter whose pooled sockets have TCP keepalive on, so idle
+    connections survive NAT/load-balancer idle timeouts between tool calls."""
+
+    def init_poolmanager(self, *args, **kwargs):
+        opts = list(HTTPConnection.default_socket_options) + [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+        for name, value in (("TCP_KEEPIDLE", 60), ("TCP_KEEPINTVL", 15), ("TCP_KEEPCNT", 4)):
+            if hasattr(socket, name):  # Linux-only knobs
+                opts.append((socket.IPPROTO_TCP, getattr(socket, name), value))
+        kwargs["socket_options"] = opts
+        super().init_poolmanager(*args, **kwargs)
+
+_os_adapter = _KeepAliveAdapter(
+    pool_connections=32,
+    pool_maxsize=32,
+    # _search/_count/_mapping are read-only, so POSTs are safe to retry too
+    max_retries=Retry(total=2, backoff_factor=0.2, status_forcelist=[502, 503, 504],
+                      allowed_methods=frozenset({"GET", "POST"})),
+)
+_SESSION.mount("http://", _os_adapter)
+_SESSION.mount("https://", _os_adapter)
+
 # ==============================================================================
 # OpenSearch helpers
 # ==============================================================================
 def os_search(body: Dict[str, Any]) -> Dict[str, Any]:
-    url = f"{BASE_URL}/{OS_INDEX}/_search"
+    url = _URL_SEARCH
     jlog("os.request", url=url, index=OS_INDEX, query_preview=_jdump(body, 500))
     try:
-        resp = requests.post(url, json=body, auth=_auth_tuple(), verify=OS_VERIFY, timeout=30)
+        resp = _SESSION.post(url, data=_dumps_bytes(body), timeout=30,
+                             headers={"Content-Type": "application/json"})
         try:
-            data = resp.json()
+            data = _loads(resp.content)
         except Exception:
             data = {"status_code": resp.status_code, "text": resp.text}
         jlog("os.response", status=resp.status_code, took=(data.get("took") if isinstance(data, dict) else None),
@@ -134,6 +224,32 @@ def os_search(body: Dict[str, Any]) -> Dict[str, Any]:
         jlog("os.error", error=str(e), url=url)
         raise RuntimeError(f"OpenSearch connection error: {e}")
 
+def os_msearch(bodies: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Run several searches against OS_INDEX in one _msearch round trip.
+
+    Returns one response per body, in order. A failed search comes back as a
+    response with an "error" key rather than raising; callers decide per query.
+    """
+    url = _URL_MSEARCH
+    jlog("os.request", url=url, index=OS_INDEX, searches=len(bodies),
+         query_preview=_jdump(bodies, 500))
+    # NDJSON: an (empty, index comes from the URL) header line before each body
+    payload = b"".join(b"{}\n" + _dumps_bytes(b) + b"\n" for b in bodies)
+    try:
+        resp = _SESSION.post(url, data=payload, timeout=30,
+                             headers={"Content-Type": "application/x-ndjson"})
+        try:
+            data = _loads(resp.content)
+        except Exception:
+            data = {"status_code": resp.status_code, "text": resp.text}
+        jlog("os.response", status=resp.status_code, took=(data.get("took") if isinstance(data, dict) else None))
+        if resp.status_code >= 300:
+            raise RuntimeError(f"OpenSearch error {resp.status_code}: {data}")
+        return data["responses"]
+    except Exception as e:
+        jlog("os.error", error=str(e), url=url)
+        raise RuntimeError(f"OpenSearch connection error: {e}")
+
 def terms_agg(field: str, species: str, size: int = 1000) -> Dict[str, Any]:
     return {
         "size": 0,
@@ -152,6 +268,39 @@ def extract_terms(resp_json: Dict[str, Any]) -> List[str]:
     except Exception:
         return []
 
+# (species, field) -> (fetched_at, unique values); breed/life_stage vocabularies
+# change on human timescales, so the taxonomy tools serve them from here
+_TAXO_CACHE: Dict[Tuple[str, str], Tuple[float, List[str]]] = {}
+_TAXO_LOCK = threading.Lock()
+
+def taxonomy_terms(species: str, fields: List[Tuple[str, int]]) -> List[List[str]]:
+    """Unique values of each (field, agg size) for a species, TTL-cached.
+
+    Fields that are missing or expired are fetched together (one _msearch
+    when there are several).
+    """
+    now = time.time()
+    found: Dict[str, List[str]] = {}
+    missing: List[Tuple[str, int]] = []
+    with _TAXO_LOCK:
+        for field, size in fields:
+            hit = _TAXO_CACHE.get((species, field))
+            if hit and now - hit[0] < TAXO_CACHE_TTL:
+                found[field] = hit[1]
+            else:
+                missing.append((field, size))
+    if missing:
+        bodies = [terms_agg(field=field, species=species, size=size) for field, size in missing]
+        responses = os_msearch(bodies) if len(bodies) > 1 else [os_search(bodies[0])]
+        for (field, _), res in zip(missing, responses):
+            if "error" in res:
+                raise RuntimeError(f"OpenSearch error: {res['error']}")
+            found[field] = extract_terms(res)
+        with _TAXO_LOCK:
+            for field, _ in missing:
+                _TAXO_CACHE[(species, field)] = (now, found[field])
+    return [found[field] for field, _ in fields]
+
 # ==============================================================================
 # MCP server + tools
 # ==============================================================================
@@ -160,11 +309,17 @@ mcp = FastMCP("pet_products_server", auth=_auth)
 _knn_available = {"ok": not DISABLE_KNN}  # runtime cache to stop retrying if cluster rejects KNN
 
 def _log_tool(event: str, name: str, **data):
-    print(json.dumps({"event": event, "tool": name, **data}, ensure_ascii=False))
+    print(_dumps({"event": event, "tool": name, **data}))
+
+# Fields echoed per sample hit by debug_opensearch_data (set membership, source order kept)
+_DEBUG_SAMPLE_FIELDS = frozenset(("title", "species", "brand", "life_stage", "food_type", "price_sale"))
+
+_SPECIES_MAP = {"dog": "Dog", "Dog": "Dog", "DOG": "Dog", "cat": "Cat", "Cat": "Cat", "CAT": "Cat"}
 
 def _normalize_species(species: str) -> str:
-    s = (species or "").strip().capitalize()
-    if s not in ("Dog", "Cat"):
+    # Common spellings hit the map directly; anything else is folded first
+    s = _SPECIES_MAP.get(species) or _SPECIES_MAP.get((species or "").strip().lower())
+    if not s:
         raise ValueError("species must be 'Dog' or 'Cat'")
     return s
 
@@ -176,28 +331,24 @@ def _normalize_species(species: str) -> str:
 def get_unique_breeds(species: str = "Dog") -> str:
     t0 = time.time()
     sp = _normalize_species(species)
-    body = terms_agg(field="breed", species=sp, size=2000)
     _log_tool("tool.request", "get_unique_breeds", args_preview=_jdump({"species": sp}))
-    res = os_search(body)
-    breeds = extract_terms(res)
+    breeds, = taxonomy_terms(sp, [("breed", 2000)])
     out = {"species": sp, "breeds": breeds, "count": len(breeds)}
     _log_tool("tool.response", "get_unique_breeds", ms=round((time.time()-t0)*1000, 1),
               result_preview=_jdump(out))
-    return json.dumps(out, ensure_ascii=False)
+    return _dumps(out)
 
 @mcp.tool(name="get_unique_life_stages",
     description="Return all unique life stages for a given species ('Dog' or 'Cat').")
 def get_unique_life_stages(species: str = "Dog") -> str:
     t0 = time.time()
     sp = _normalize_species(species)
-    body = terms_agg(field="life_stage", species=sp, size=100)
     _log_tool("tool.request", "get_unique_life_stages", args_preview=_jdump({"species": sp}))
-    res = os_search(body)
-    stages = extract_terms(res)
+    stages, = taxonomy_terms(sp, [("life_stage", 100)])
     out = {"species": sp, "life_stages": stages, "count": len(stages)}
     _log_tool("tool.response", "get_unique_life_stages", ms=round((time.time()-t0)*1000, 1),
               result_preview=_jdump(out))
-    return json.dumps(out, ensure_ascii=False)
+    return _dumps(out)
 
 @mcp.tool(name="get_taxonomy",
     description="Return both unique breeds and life stages for a species ('Dog' or 'Cat').")
@@ -205,14 +356,11 @@ def get_taxonomy(species: str = "Dog") -> str:
     t0 = time.time()
     sp = _normalize_species(species)
     _log_tool("tool.request", "get_taxonomy", args_preview=_jdump({"species": sp}))
-    res_b = os_search(terms_agg(field="breed", species=sp, size=2000))
-    res_l = os_search(terms_agg(field="life_stage", species=sp, size=100))
-    breeds = extract_terms(res_b)
-    stages = extract_terms(res_l)
+    breeds, stages = taxonomy_terms(sp, [("breed", 2000), ("life_stage", 100)])
     out = {"species": sp, "breeds": breeds, "life_stages": stages}
     _log_tool("tool.response", "get_taxonomy", ms=round((time.time()-t0)*1000, 1),
               result_preview=_jdump(out))
-    return json.dumps(out, ensure_ascii=False)
+    return _dumps(out)
 
 # ==============================================================================
 # New Tool: search_products
@@ -227,36 +375,36 @@ def debug_opensearch_data() -> str:
     
     try:
         # Get total count
-        count_url = f"{BASE_URL}/{OS_INDEX}/_count"
-        count_resp = requests.get(count_url, auth=_auth_tuple(), verify=OS_VERIFY, timeout=10)
-        total_docs = count_resp.json().get("count", 0) if count_resp.status_code == 200 else 0
+        count_url = _URL_COUNT
+        count_resp = _SESSION.get(count_url, timeout=10)
+        total_docs = _loads(count_resp.content).get("count", 0) if count_resp.status_code == 200 else 0
         
         # Get sample documents
-        sample_url = f"{BASE_URL}/{OS_INDEX}/_search"
+        sample_url = _URL_SEARCH
         sample_body = {"size": 3, "query": {"match_all": {}}}
-        sample_resp = requests.post(sample_url, json=sample_body, auth=_auth_tuple(), verify=OS_VERIFY, timeout=10)
+        sample_resp = _SESSION.post(sample_url, json=sample_body, timeout=10)
         
         sample_docs = []
         if sample_resp.status_code == 200:
-            hits = sample_resp.json().get("hits", {}).get("hits", [])
+            hits = _loads(sample_resp.content).get("hits", {}).get("hits", [])
             for hit in hits:
                 source = hit.get("_source", {})
                 sample_docs.append({
                     "id": hit.get("_id"),
                     "fields": list(source.keys()),
-                    "sample_data": {k: v for k, v in source.items() if k in ["title", "species", "brand", "life_stage", "food_type", "price_sale"]}
+                    "sample_data": {k: source[k] for k in _DEBUG_SAMPLE_FIELDS & source.keys()}
                 })
         
         # Get field mappings
-        mapping_url = f"{BASE_URL}/{OS_INDEX}/_mapping"
-        mapping_resp = requests.get(mapping_url, auth=_auth_tuple(), verify=OS_VERIFY, timeout=10)
+        mapping_url = _URL_MAPPING
+        mapping_resp = _SESSION.get(mapping_url, timeout=10)
         field_mappings = {}
         if mapping_resp.status_code == 200:
-            properties = mapping_resp.json().get(OS_INDEX, {}).get("mappings", {}).get("properties", {})
+            properties = _loads(mapping_resp.content).get(OS_INDEX, {}).get("mappings", {}).get("properties", {})
             field_mappings = {k: v.get("type", "unknown") for k, v in properties.items()}
         
         # Test species field values
-        species_url = f"{BASE_URL}/{OS_INDEX}/_search"
+        species_url = _URL_SEARCH
         species_body = {
             "size": 0,
             "aggs": {
@@ -264,11 +412,11 @@ def debug_opensearch_data() -> str:
                 "species_text": {"terms": {"field": "species", "size": 10}}
             }
         }
-        species_resp = requests.post(species_url, json=species_body, auth=_auth_tuple(), verify=OS_VERIFY, timeout=10)
+        species_resp = _SESSION.post(species_url, json=species_body, timeout=10)
         
         species_values = {"keyword": [], "text": []}
         if species_resp.status_code == 200:
-            aggs = species_resp.json().get("aggregations", {})
+            aggs = _loads(species_resp.content).get("aggregations", {})
             species_values["keyword"] = [b["key"] for b in aggs.get("species_values", {}).get("buckets", [])]
             species_values["text"] = [b["key"] for b in aggs.get("species_text", {}).get("buckets", [])]
         
@@ -292,7 +440,7 @@ def debug_opensearch_data() -> str:
     
     _log_tool("tool.response", "debug_opensearch_data", ms=round((time.time()-t0)*1000, 1),
               result_preview=_jdump(out))
-    return json.dumps(out, ensure_ascii=False)
+    return _dumps(out)
 
 @mcp.tool(
     name="test_opensearch_connection",
@@ -304,21 +452,21 @@ def test_opensearch_connection() -> str:
     
     try:
         # Test basic connection
-        url = f"{BASE_URL}/{OS_INDEX}/_count"
-        resp = requests.get(url, auth=_auth_tuple(), verify=OS_VERIFY, timeout=10)
+        url = _URL_COUNT
+        resp = _SESSION.get(url, timeout=10)
         
         if resp.status_code == 200:
-            count_data = resp.json()
+            count_data = _loads(resp.content)
             total_docs = count_data.get("count", 0)
             
             # Get a sample document
-            sample_url = f"{BASE_URL}/{OS_INDEX}/_search"
+            sample_url = _URL_SEARCH
             sample_body = {"size": 1, "query": {"match_all": {}}}
-            sample_resp = requests.post(sample_url, json=sample_body, auth=_auth_tuple(), verify=OS_VERIFY, timeout=10)
+            sample_resp = _SESSION.post(sample_url, json=sample_body, timeout=10)
             
             sample_data = {}
             if sample_resp.status_code == 200:
-                hits = sample_resp.json().get("hits", {}).get("hits", [])
+                hits = _loads(sample_resp.content).get("hits", {}).get("hits", [])
                 if hits:
                     sample_data = hits[0].get("_source", {})
             
@@ -348,33 +496,88 @@ def test_opensearch_connection() -> str:
     
     _log_tool("tool.response", "test_opensearch_connection", ms=round((time.time()-t0)*1000, 1),
               result_preview=_jdump(out))
-    return json.dumps(out, ensure_ascii=False)
-
-@mcp.tool(
-    name="search_products",
-    description="Search pet products using hybrid BM25 (and optional vector KNN) over the OpenSearch index. Parameters: query (string; free-text query), species (Dog|Cat; required), filters (dict; flexible filters for any schema field), page (1-based), size (page size), embedding_text (string; if provided, enables vector KNN fusion). Available filter fields: life_stage, food_type, flavour, tags_any, price_min/price_max, exclude_ingredients, breed_soft, brand, manufacturer, rating, num_reviews, discount_value, pack_size, availability.in_stock, country_of_origin, etc. Returns JSON with results, total, page, size, and mode (bm25|hybrid)."
-)
-def search_products(
-    query: str,
-    species: str = "Dog",
-    filters: dict = {},
-    page: int = 1,
-    size: int = 3,
-    embedding_text: str = ""
-) -> str:
-    t0 = time.time()
-    sp = _normalize_species(species)
-     
-    # Log request with key parameters
-    request_args = {
-        "query": query, "species": sp, "filters": filters,
-        "page": page, "size": size, "embedding_text": bool(embedding_text)
-    }
-    _log_tool("tool.request", "search_products", args_preview=_jdump(request_args))
-
-    def _csv_list(s: str) -> list:
-        return [x.strip() for x in (s or "").split(",") if x.strip()]
-
+    return _dumps(out)
+
+def _csv_list(s: str) -> list:
+    return [x.strip() for x in (s or "").split(",") if x.strip()]
+
+def _as_list(value: Any) -> list:
+    if isinstance(value, str):
+        return _csv_list(value)
+    if isinstance(value, list):
+        return value
+    return [str(value)]
+
+def _term_filter(field: str):
+    def handler(value, filt, should, must_not):
+        filt.append({"term": {field: value}})
+    return handler
+
+def _range_filter(field: str, op: str, cast):
+    def handler(value, filt, should, must_not):
+        if isinstance(value, dict):
+            # Handle range queries like {"gte": 4.0}
+            filt.append({"range": {field: value}})
+        else:
+            # Handle simple value like 4.0
+            filt.append({"range": {field: {op: cast(value)}}})
+    return handler
+
+def _life_stage_filter(value, filt, should, must_not):
+    if isinstance(value, str) and value.lower() != "all":
+        # Include documents that match the requested stage OR 'All'
+        filt.append({"terms": {"life_stage": [value, "All"]}})
+    elif isinstance(value, str) and value.lower() == "all":
+        should.append({"term": {"life_stage": "All"}})
+
+def _tags_any_filter(value, filt, should, must_not):
+    tags_list = _as_list(value)
+    if tags_list:
+        should.append({"terms": {"tags": tags_list}})
+
+def _availability_filter(value, filt, should, must_not):
+    filt.append({"term": {"availability.in_stock": bool(value)}})
+
+def _exclude_ingredients_filter(value, filt, should, must_not):
+    for ex in _as_list(value):
+        # One must_not clause per excluded term covering both fields
+        must_not.append({"bool": {"should": [
+            {"match_phrase": {"ingredients": ex}},
+            {"match_phrase": {"flavour": ex}},
+        ]}})
+
+def _breed_soft_filter(value, filt, should, must_not):
+    should.append({"match": {"searchable_text": {"query": value, "operator": "and"}}})
+
+# The only _source fields search_products reads (result rows + the RRF id fallback);
+# KNN hits are shown too, so both queries fetch the same set
+RESULT_SOURCE_FIELDS = [
+    "title", "brand", "price_sale", "price.sale", "price.currency", "availability.in_stock",
+    "life_stage", "flavour", "food_type", "rating", "num_reviews", "variant_id",
+]
+
+# search_products filter name -> handler(value, filt, should, must_not);
+# price_min/price_max are combined into one range outside this table
+SEARCH_FILTER_HANDLERS = {
+    "life_stage": _life_stage_filter,
+    "food_type": _term_filter("food_type"),
+    "flavour": _term_filter("flavour"),
+    "brand": _term_filter("brand"),
+    "manufacturer": _term_filter("manufacturer"),
+    "pack_size": _term_filter("pack_size"),
+    "country_of_origin": _term_filter("country_of_origin"),
+    "tags_any": _tags_any_filter,
+    "rating": _range_filter("rating", "gte", float),
+    "num_reviews": _range_filter("num_reviews", "gte", int),
+    "discount_value": _range_filter("discount_value", "gt", float),
+    "availability.in_stock": _availability_filter,
+    "exclude_ingredients": _exclude_ingredients_filter,
+    "breed_soft": _breed_soft_filter,
+}
+
+def _build_search_bodies(query: str, sp: str, filters: dict, size: int,
+                         embedding_text: str) -> Tuple[dict, Optional[dict]]:
+    """BM25 body and, when an embedding is available, the KNN body for one search."""
     must, should, filt, must_not = [], [], [], []
     
     # Use species field (text type) since species.keyword is empty
@@ -382,96 +585,24 @@ def search_products(
     
     # Process flexible filters
     for field, value in filters.items():
-        if not value:
+        if not value or field in ("price_min", "price_max"):
             continue
-            
-        # Handle different filter types
-        if field == "life_stage":
-            if isinstance(value, str) and value.lower() != "all":
-                # Include documents that match the requested stage OR 'All'
-                filt.append({"terms": {"life_stage": [value, "All"]}})
-            elif isinstance(value, str) and value.lower() == "all":
-                should.append({"term": {"life_stage": "All"}})
-                
-        elif field == "food_type":
-            filt.append({"term": {"food_type": value}})
-            
-        elif field == "flavour":
-            filt.append({"term": {"flavour": value}})
-            
-        elif field == "brand":
-            filt.append({"term": {"brand": value}})
-            
-        elif field == "manufacturer":
-            filt.append({"term": {"manufacturer": value}})
-            
-        elif field == "pack_size":
-            filt.append({"term": {"pack_size": value}})
-            
-        elif field == "country_of_origin":
-            filt.append({"term": {"country_of_origin": value}})
-            
-        elif field == "tags_any":
-            if isinstance(value, str):
-                tags_list = _csv_list(value)
-            elif isinstance(value, list):
-                tags_list = value
-            else:
-                tags_list = [str(value)]
-            if tags_list:
-                should.append({"terms": {"tags": tags_list}})
-                
-        elif field in ["price_min", "price_max"]:
-            # Handle price range
-            price_range = {}
-            if "price_min" in filters and filters["price_min"]:
-                price_range["gte"] = float(filters["price_min"])
-            if "price_max" in filters and filters["price_max"]:
-                price_range["lte"] = float(filters["price_max"])
-            if price_range:
-                filt.append({"range": {"price_sale": price_range}})
-                
-        elif field == "rating":
-            if isinstance(value, dict):
-                # Handle range queries like {"gte": 4.0}
-                filt.append({"range": {"rating": value}})
-            else:
-                # Handle simple value like 4.0
-                filt.append({"range": {"rating": {"gte": float(value)}}})
-                
-        elif field == "num_reviews":
-            if isinstance(value, dict):
-                filt.append({"range": {"num_reviews": value}})
-            else:
-                filt.append({"range": {"num_reviews": {"gte": int(value)}}})
-                
-        elif field == "discount_value":
-            if isinstance(value, dict):
-                filt.append({"range": {"discount_value": value}})
-            else:
-                filt.append({"range": {"discount_value": {"gt": float(value)}}})
-                
-        elif field == "availability.in_stock":
-            filt.append({"term": {"availability.in_stock": bool(value)}})
-            
-        elif field == "exclude_ingredients":
-            if isinstance(value, str):
-                excl_list = _csv_list(value)
-            elif isinstance(value, list):
-                excl_list = value
-            else:
-                excl_list = [str(value)]
-            for ex in excl_list:
-                must_not.append({"match_phrase": {"ingredients": ex}})
-                must_not.append({"match_phrase": {"flavour": ex}})
-                
-        elif field == "breed_soft":
-            should.append({"match": {"searchable_text": {"query": value, "operator": "and"}}})
-            
+        handler = SEARCH_FILTER_HANDLERS.get(field)
+        if handler is not None:
+            handler(value, filt, should, must_not)
         else:
             # Generic term filter for other fields
             filt.append({"term": {field: value}})
 
+    # Handle price range (built once, whichever of the two keys are set)
+    price_range = {}
+    if filters.get("price_min"):
+        price_range["gte"] = float(filters["price_min"])
+    if filters.get("price_max"):
+        price_range["lte"] = float(filters["price_max"])
+    if price_range:
+        filt.append({"range": {"price_sale": price_range}})
+
     # Build query text from filters if no explicit query provided
     if not query.strip():
         query_parts = [f"best food for {sp.lower()}"]
@@ -483,96 +614,89 @@ def search_products(
     else:
         qtext = query.strip()
     
-    # Try multiple text search approaches
-    text_queries = [
-        {
-            "multi_match": {
-                "query": qtext,
-                "fields": ["title^5", "brand^3", "tags^3", "food_type^3", "flavour^2", "ingredients", "description", "searchable_text"],
-                "type": "best_fields",
-                "operator": "and"
-            }
-        },
-        {
-            "multi_match": {
-                "query": qtext,
-                "fields": ["title^5", "brand^3", "tags^3", "food_type^3", "flavour^2", "ingredients", "description"],
-                "type": "best_fields",
-                "operator": "or"
-            }
-        },
-        {
-            "match": {
-                "title": {"query": qtext, "boost": 5}
-            }
+    # One best_fields multi_match scores each document once; minimum_should_match
+    # keeps short queries strict (all terms) and lets longer ones match most terms
+    must.append({
+        "multi_match": {
+            "query": qtext,
+            "fields": ["title^5", "brand^3", "tags^3", "food_type^3", "flavour^2", "ingredients", "description", "searchable_text"],
+            "type": "best_fields",
+            "operator": "or",
+            "minimum_should_match": "2<70%",
+            "tie_breaker": 0.2
         }
-    ]
-    must.append({"bool": {"should": text_queries, "minimum_should_match": 1}})
+    })
+
+    # Fusion only returns the top 5, so a small candidate pool per branch is enough
+    cand = min(max(size * 2, 20), 150)
 
     bm25_body = {
-        "size": min(max(size * 3, size), 150),
+        "size": cand,
+        "terminate_after": 5000,
         "query": {"bool": {"must": must, "filter": filt, "should": should, "must_not": must_not}},
-        "_source": True
+        "_source": RESULT_SOURCE_FIELDS
     }
-    bm25_res = os_search(bm25_body)
-    bm25_hits = ((bm25_res.get("hits") or {}).get("hits") or [])
 
-    knn_hits = []
+    knn_body = None
     if embedding_text and _knn_available["ok"]:
-        vec = embed_text_with_openai(embedding_text)
+        vec = embed_text_cached(embedding_text)
         if vec:
-            try:
-                knn_body = {
-                    "size": min(max(size * 3, size), 150),
-                    "query": {
-                        "bool": {
-                            "filter": filt,
-                            "must_not": must_not,
-                            "must": [
-                                {
-                                    "knn": {
-                                        "embedding_product": {
-                                            "vector": vec,
-                                            "k": 100,
-                                            "method_parameters": {"ef_search": 200},
-                                            "rescore": {"oversample_factor": 2.0}
-                                        }
+            knn_body = {
+                "size": cand,
+                "query": {
+                    "bool": {
+                        "filter": filt,
+                        "must_not": must_not,
+                        "must": [
+                            {
+                                "knn": {
+                                    "embedding_product": {
+                                        "vector": vec,
+                                        "k": 100,
+                                        "method_parameters": {"ef_search": 200},
+                                        "rescore": {"oversample_factor": 2.0}
                                     }
                                 }
-                            ]
-                        }
-                    },
-                    "_source": True
-                }
-                _log_tool("tool.request", "search_products.knn", args_preview=_jdump({"vector_len": len(vec)}))
-                knn_res = os_search(knn_body)
-                knn_hits = ((knn_res.get("hits") or {}).get("hits") or [])
-            except Exception as e:
-                _log_tool("tool.warn", "search_products.knn_failed", error=str(e))
-                if "Unknown key" in str(e) or "parsing_exception" in str(e):
-                    _knn_available["ok"] = False
-
-    def rrf(hits, k=60):
-        ranks = {}
-        for idx, h in enumerate(hits, start=1):
+                            }
+                        ]
+                    }
+                },
+                "_source": RESULT_SOURCE_FIELDS
+            }
+            _log_tool("tool.request", "search_products.knn", args_preview=_jdump({"vector_len": len(vec)}))
+
+    return bm25_body, knn_body
+
+def _knn_hits(knn_res: dict) -> list:
+    if "error" in knn_res:
+        err = str(knn_res["error"])
+        _log_tool("tool.warn", "search_products.knn_failed", error=err)
+        if "Unknown key" in err or "parsing_exception" in err:
+            _knn_available["ok"] = False
+        return []
+    return ((knn_res.get("hits") or {}).get("hits") or [])
+
+def _fuse_results(bm25_hits: list, knn_hits: list) -> Tuple[list, int]:
+    """Top-5 result rows and the fused candidate total."""
+    # Reciprocal rank fusion (k=60) in one pass over both lists; on shared ids the
+    # KNN hit is the one displayed, as before
+    fused: Dict[str, float] = {}
+    docmap: Dict[str, Any] = {}
+    for hits in (bm25_hits, knn_hits):
+        for rank, h in enumerate(hits, start=1):
             _id = h.get("_id") or (h.get("_source") or {}).get("variant_id") or ""
             if not _id:
                 continue
-            ranks[_id] = ranks.get(_id, 0.0) + 1.0 / (k + idx)
-        return ranks
-
-    fused = rrf(bm25_hits)
-    if knn_hits:
-        knn_scores = rrf(knn_hits)
-        for did, s in knn_scores.items():
-            fused[did] = fused.get(did, 0.0) + s
-
-    docmap = {_h.get("_id"): _h for _h in (bm25_hits + knn_hits) if _h.get("_id")}
-    ranked = sorted(fused.items(), key=lambda kv: kv[1], reverse=True)
-    ranked_docs = [docmap[i] for i, _ in ranked] if ranked else bm25_hits
+            fused[_id] = fused.get(_id, 0.0) + 1.0 / (60 + rank)
+            docmap[_id] = h
 
-    # Return top 5 after fusion
-    page_docs = ranked_docs[:5]
+    # Return top 5 after fusion; only those need ordering, not the whole candidate set
+    if fused:
+        page_docs = [docmap[i] for i in heapq.nlargest(5, fused, key=fused.get)]
+        total = len(fused)
+    else:
+        page_docs = bm25_hits[:5]
+        total = len(bm25_hits)
 
     results = []
     for h in page_docs:
@@ -592,11 +716,96 @@ def search_products(
             "num_reviews": s.get("num_reviews")
         })
 
-    out = {"results": results, "total": len(ranked_docs), "page": page, "size": 5,
+    return results, total
+
+@mcp.tool(
+    name="search_products",
+    description="Search pet products using hybrid BM25 (and optional vector KNN) over the OpenSearch index. Parameters: query (string; free-text query), species (Dog|Cat; required), filters (dict; flexible filters for any schema field), page (1-based), size (page size), embedding_text (string; if provided, enables vector KNN fusion). Available filter fields: life_stage, food_type, flavour, tags_any, price_min/price_max, exclude_ingredients, breed_soft, brand, manufacturer, rating, num_reviews, discount_value, pack_size, availability.in_stock, country_of_origin, etc. Returns JSON with results, total, page, size, and mode (bm25|hybrid)."
+)
+def search_products(
+    query: str,
+    species: str = "Dog",
+    filters: dict = {},
+    page: int = 1,
+    size: int = 3,
+    embedding_text: str = ""
+) -> str:
+    t0 = time.time()
+    sp = _normalize_species(species)
+     
+    # Log request with key parameters
+    request_args = {
+        "query": query, "species": sp, "filters": filters,
+        "page": page, "size": size, "embedding_text": bool(embedding_text)
+    }
+    _log_tool("tool.request", "search_products", args_preview=_jdump(request_args))
+
+    bm25_body, knn_body = _build_search_bodies(query, sp, filters, size, embedding_text)
+
+    # BM25 and (when an embedding is available) KNN go out in one _msearch round trip
+    responses = os_msearch([bm25_body] if knn_body is None else [bm25_body, knn_body])
+    bm25_res = responses[0]
+    if "error" in bm25_res:
+        raise RuntimeError(f"OpenSearch error: {bm25_res['error']}")
+    bm25_hits = ((bm25_res.get("hits") or {}).get("hits") or [])
+    knn_hits = _knn_hits(responses[1]) if len(responses) > 1 else []
+
+    results, total = _fuse_results(bm25_hits, knn_hits)
+    out = {"results": results, "total": total, "page": page, "size": 5,
            "mode": "hybrid" if knn_hits else "bm25"}
     _log_tool("tool.response", "search_products", ms=round((time.time()-t0)*1000, 1),
               result_preview=_jdump({"returned": len(results), "mode": out["mode"]}))
-    return json.dumps(out, ensure_ascii=False)
+    return _dumps(out)
+
+@mcp.tool(
+    name="search_products_batch",
+    description="Run several search_products searches in one OpenSearch round trip. Parameters: queries (list of objects, each with the search_products arguments: query, species, filters, page, size, embedding_text). Returns JSON with one entry per query, in order, each shaped like a search_products response (or {error} if that query failed)."
+)
+def search_products_batch(queries: list) -> str:
+    t0 = time.time()
+    _log_tool("tool.request", "search_products_batch", args_preview=_jdump({"queries": queries}))
+
+    # Every query's BM25 (and KNN) body goes into a single _msearch; slots maps
+    # each query back to its response indexes
+    bodies: List[dict] = []
+    slots: List[Any] = []
+    for q in queries:
+        try:
+            sp = _normalize_species(q.get("species", "Dog"))
+            bm25_body, knn_body = _build_search_bodies(
+                q.get("query") or "", sp, q.get("filters") or {},
+                int(q.get("size") or 3), q.get("embedding_text") or "")
+        except Exception as e:
+            slots.append(str(e))
+            continue
+        slots.append((len(bodies), knn_body is not None))
+        bodies.append(bm25_body)
+        if knn_body is not None:
+            bodies.append(knn_body)
+
+    responses = os_msearch(bodies) if bodies else []
+
+    batch = []
+    for q, slot in zip(queries, slots):
+        if isinstance(slot, str):
+            batch.append({"error": slot})
+            continue
+        idx, has_knn = slot
+        bm25_res = responses[idx]
+        if "error" in bm25_res:
+            batch.append({"error": f"OpenSearch error: {bm25_res['error']}"})
+            continue
+        bm25_hits = ((bm25_res.get("hits") or {}).get("hits") or [])
+        knn_hits = _knn_hits(responses[idx + 1]) if has_knn else []
+        results, total = _fuse_results(bm25_hits, knn_hits)
+        batch.append({"results": results, "total": total, "page": int(q.get("page") or 1), "size": 5,
+                      "mode": "hybrid" if knn_hits else "bm25"})
+
+    out = {"batch": batch}
+    _log_tool("tool.response", "search_products_batch", ms=round((time.time()-t0)*1000, 1),
+              result_preview=_jdump({"queries": len(queries), "bodies": len(bodies)}))
+    return _dumps(out)
+
 
 # ==============================================================================
 # HTTP app + middleware
@@ -620,10 +829,57 @@ class IgnoreDeleteMiddleware(BaseHTTPMiddleware):
 app = IgnoreDeleteMiddleware(app)
 # --- END: swallow DELETE /mcp ---
 
+@lru_cache(maxsize=1024)
+def _token_digest(t: str) -> str:
+    # The same few bearer tokens arrive on every request; hash each once
+    return hashlib.sha256(t.encode()).hexdigest()[:10]
+
+def token_repr(t: str) -> str:
+    if not t: return "none"
+    if LOG_SHOW_TOKENS: return t
+    preview = (t[:6] + "..." + t[-4:]) if len(t) > 12 else "masked"
+    return f"{preview} sha256:{_token_digest(t)}"
+
 class RequestResponseLogger(BaseHTTPMiddleware):
+    def __init__(self, app):
+        super().__init__(app)
+        self._log_q: Optional[asyncio.Queue] = None
+        self._log_task: Optional[asyncio.Task] = None
+        self._log_dropped = 0
+
+    async def _log_worker(self, q: asyncio.Queue):
+        # Drains log blocks so printing never sits between the handler and the client
+        while True:
+            lines = await q.get()
+            try:
+                if self._log_dropped:
+                    dropped, self._log_dropped = self._log_dropped, 0
+                    print(f"[log queue full: dropped {dropped} log blocks]")
+                print("\n".join(lines))
+            except Exception:
+                pass  # a bad line must not kill the worker
+
+    def _emit(self, *lines: str):
+        loop = asyncio.get_running_loop()
+        # (Re)start the worker on first use, if it died, or if the loop changed (reload, tests)
+        if self._log_task is None or self._log_task.done() or self._log_task.get_loop() is not loop:
+            self._log_q = asyncio.Queue(maxsize=LOG_QUEUE_SIZE)
+            self._log_task = loop.create_task(self._log_worker(self._log_q))
+        try:
+            self._log_q.put_nowait(lines)
+        except asyncio.QueueFull:
+            # stdout can't keep up; drop rather than buffer without bound
+            self._log_dropped += 1
+
     async def dispatch(self, request, call_next):
         hdr = request.headers
-        body = await request.body()
+        # Large or chunked uploads are left for the handler to stream rather than buffered here
+        try:
+            clen = int(hdr.get("content-length") or 0)
+        except ValueError:
+            clen = 0
+        body_skipped = clen > LOG_BODY_LIMIT or "chunked" in hdr.get("transfer-encoding", "").lower()
+        body = b"" if body_skipped else await request.body()
 
         # Auth header analysis
         auth_header = hdr.get("authorization", "")
@@ -633,47 +889,54 @@ class RequestResponseLogger(BaseHTTPMiddleware):
             scheme = parts[0]
             token = parts[1] if len(parts) > 1 else ""
 
-        def token_repr(t: str) -> str:
-            if not t: return "none"
-            if LOG_SHOW_TOKENS: return t
-            digest = hashlib.sha256(t.encode()).hexdigest()[:10]
-            preview = (t[:6] + "..." + t[-4:]) if len(t) > 12 else "masked"
-            return f"{preview} sha256:{digest}"
-
-        print("=== REQUEST ===")
-        print(f"{request.client.host} {request.method} {request.url.path}")
-        print(f"Headers: {dict(hdr)}")
-        print(f"Auth: scheme={scheme or 'none'} received={token_repr(token)}")
         clip_req = body if len(body) <= LOG_BODY_LIMIT else body[:LOG_BODY_LIMIT] + b"\n...[truncated]"
-        print("Body:", clip_req.decode("utf-8", errors="replace") if body else "<empty>")
+        self._emit(
+            "=== REQUEST ===",
+            f"{request.client.host} {request.method} {request.url.path}",
+            "Headers: " + _dumps(dict(hdr)),
+            f"Auth: scheme={scheme or 'none'} received={token_repr(token)}",
+            "Body: " + (f"<skipped {clen or 'chunked'} bytes>" if body_skipped
+                        else clip_req.decode("utf-8", errors="replace") if body else "<empty>"),
+        )
 
         response = await call_next(request)
 
+        # Response headers are rendered once and shared by both log paths
+        status, resp_headers = response.status_code, _dumps(dict(response.headers))
         ctype = response.headers.get("content-type", "")
         if ctype.startswith("text/event-stream"):
-            print("=== RESPONSE ===")
-            print(f"Status: {response.status_code}")
-            print(f"Headers: {dict(response.headers)}")
-            print("Body: <streaming>")
+            self._emit(
+                "=== RESPONSE ===",
+                f"Status: {status}",
+                "Headers: " + resp_headers,
+                "Body: <streaming>",
+            )
             return response
 
-        resp_body = b""
-        async for chunk in response.body_iterator:
-            resp_body += chunk
-
-        print("=== RESPONSE ===")
-        print(f"Status: {response.status_code}")
-        print(f"Headers: {dict(response.headers)}")
-        clip_resp = resp_body if len(resp_body) <= LOG_BODY_LIMIT else resp_body[:LOG_BODY_LIMIT] + b"\n...[truncated]"
-        print("Body:", clip_resp.decode("utf-8", errors="replace") if resp_body else "<empty>")
-
-        return Response(
-            content=resp_body,
-            status_code=response.status_code,
-            headers=dict(response.headers),
-            media_type=response.media_type,
-            background=response.background,
-        )
+        # Tee the body: chunks go to the client as they arrive and only the
+        # first LOG_BODY_LIMIT bytes are kept for the log line
+        body_iter = response.body_iterator
+
+        async def tee():
+            kept: List[bytes] = []
+            kept_len = total = 0
+            async for chunk in body_iter:
+                yield chunk
+                total += len(chunk)
+                if kept_len < LOG_BODY_LIMIT:
+                    kept.append(chunk)
+                    kept_len += len(chunk)
+            resp_body = b"".join(kept)
+            clip_resp = resp_body if total <= LOG_BODY_LIMIT else resp_body[:LOG_BODY_LIMIT] + b"\n...[truncated]"
+            self._emit(
+                "=== RESPONSE ===",
+                f"Status: {status}",
+                "Headers: " + resp_headers,
+                "Body: " + (clip_resp.decode("utf-8", errors="replace") if total else "<empty>"),
+            )
+
+        response.body_iterator = tee()
+        return response
 
 app = CORSMiddleware(app, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"], expose_headers=["*"])
 app = RequestResponseLogger(app)
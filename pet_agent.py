@@ -12,16 +12,27 @@ Version: 2.0.0
 """
 
 import os
+import re
+import ssl
 import logging
 import json
 import time
+import threading
 import httpx
-from typing import Any, Dict, List, Optional
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Tuple
 from agents.agent import Agent, ModelSettings
 from agents.tool import function_tool
 from openai.types.shared.reasoning import Reasoning
 
 # ChatKit imports for agent compatibility
+try:
+    # C-speed JSON for OpenSearch responses and tool output; stdlib json otherwise
+    import orjson  # type: ignore
+except ImportError:
+    orjson = None
+
 try:
     from chatkit.agents import AgentContext
     CHATKIT_AVAILABLE = True
@@ -34,29 +45,174 @@ except ImportError:
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+
+def _dumps(obj: Any) -> str:
+    """Serialize tool output as UTF-8 JSON text (non-ASCII kept as is)."""
+    if orjson is not None:
+        return orjson.dumps(obj).decode("utf-8")
+    return json.dumps(obj, ensure_ascii=False)
+
+
+def _loads(data: bytes) -> Any:
+    return orjson.loads(data) if orjson is not None else json.loads(data)
+
+# =============================================================================
+# OPENSEARCH CONNECTION
+# =============================================================================
+
+OS_HOST = os.getenv("OS_HOST", "localhost")
+OS_PORT = os.getenv("OS_PORT", "9200")
+OS_USER = os.getenv("OS_USER", "admin")
+OS_PASS = os.getenv("OS_PASS", "YourStrongP@ssw0rd!")
+OS_INDEX = os.getenv("OS_INDEX", "products_pets_v3")
+# TLS: OS_INSECURE=1 (default, matching the self-signed dev cluster) skips certificate
+# checks; set OS_INSECURE=0 and optionally OS_CA_CERT to verify against a CA bundle
+OS_INSECURE = os.getenv("OS_INSECURE", "1") == "1"
+OS_CA_CERT = os.getenv("OS_CA_CERT")
+# Keyword subfield holding one normalized term per ingredient (e.g. "ingredients.keyword"
+# with a lowercase + asciifolding normalizer). When set, exclude_ingredients becomes a
+# single terms filter; unset keeps the per-ingredient match_phrase exclusions, which also
+# work when ingredients is only indexed as free text.
+EXCLUDE_INGREDIENTS_FIELD = os.getenv("EXCLUDE_INGREDIENTS_FIELD", "")
+
+try:
+    import h2  # noqa: F401 - httpx needs it for HTTP/2
+    _OS_HTTP2 = True
+except ImportError:
+    _OS_HTTP2 = False
+
+def _os_ssl_context() -> ssl.SSLContext:
+    """Build the one SSLContext the pooled client uses for every connection."""
+    if OS_INSECURE:
+        ctx = ssl.create_default_context()
+        ctx.check_hostname = False
+        ctx.verify_mode = ssl.CERT_NONE
+        return ctx
+    return ssl.create_default_context(cafile=OS_CA_CERT)
+
+
+# One pooled keep-alive async client shared by every tool call, so searches reuse
+# open connections and the OpenSearch round trip never blocks the event loop. Idle
+# connections are kept for 30s (httpx default: 5s) so tool calls a few seconds apart
+# reuse the warm TLS session; retries=1 only retries failed connects.
+_OS_CLIENT = httpx.AsyncClient(
+    base_url=f"https://{OS_HOST}:{OS_PORT}",
+    auth=(OS_USER, OS_PASS),
+    timeout=30.0,
+    transport=httpx.AsyncHTTPTransport(
+        verify=_os_ssl_context(),
+        http2=_OS_HTTP2,
+        limits=httpx.Limits(max_connections=32, max_keepalive_connections=32, keepalive_expiry=30.0),
+        retries=1,
+    ),
+)
+
+
+async def close_search_client() -> None:
+    """Close the pooled OpenSearch client (call from the app's shutdown hook)."""
+    await _OS_CLIENT.aclose()
+
+# Short-lived cache of first-page tool results keyed by the raw tool arguments
+SEARCH_CACHE_TTL = float(os.getenv("SEARCH_CACHE_TTL", "60"))  # seconds; 0 disables
+SEARCH_CACHE_SIZE = 256
+_SEARCH_CACHE: "OrderedDict[tuple, Tuple[float, str]]" = OrderedDict()
+_SEARCH_CACHE_LOCK = threading.Lock()
+
+
+def _search_cache_get(key: tuple) -> Optional[str]:
+    if SEARCH_CACHE_TTL <= 0:
+        return None
+    with _SEARCH_CACHE_LOCK:
+        hit = _SEARCH_CACHE.get(key)
+        if hit is None:
+            return None
+        if time.monotonic() - hit[0] >= SEARCH_CACHE_TTL:
+            del _SEARCH_CACHE[key]
+            return None
+        _SEARCH_CACHE.move_to_end(key)
+        return hit[1]
+
+
+def _search_cache_put(key: tuple, value: str) -> None:
+    if SEARCH_CACHE_TTL <= 0:
+        return
+    with _SEARCH_CACHE_LOCK:
+        _SEARCH_CACHE[key] = (time.monotonic(), value)
+        _SEARCH_CACHE.move_to_end(key)
+        while len(_SEARCH_CACHE) > SEARCH_CACHE_SIZE:
+            _SEARCH_CACHE.popitem(last=False)
+
 # =============================================================================
 # SIMPLE SEARCH TOOL IMPLEMENTATION
 # =============================================================================
 
-@function_tool(description_override="Search pet products using OpenSearch. Parameters: query (string; free-text search query), species (Dog|Cat; required), filters (JSON string with any combination of: life_stage, food_type, flavour, brand, breed, categories, country_of_origin, discount_type, discount_value, manufacturer, model, pack_size, price_min, price_max, rating, tags, tags_any, exclude_ingredients, breed_soft, availability_in_stock, availability_backorderable, availability_stock_qty, availability_lead_time_days, shelf_life, storage_info, safety_info, uom, dimensions_size_unit, dimensions_size_value, dimensions_volume_unit, dimensions_volume_value, dimensions_weight_unit, dimensions_weight_value, page, size). Returns JSON with results, total, page, size, and mode.")
-def search_products_tool(
-    query: str,
-    species: str,
-    filters: str = "{}"
-) -> str:
+# Species spellings the agents send, resolved with one dict lookup; anything else is
+# folded with lower() and unknown species default to Dog
+_SPECIES_MAP = {"dog": "Dog", "Dog": "Dog", "DOG": "Dog", "cat": "Cat", "Cat": "Cat", "CAT": "Cat"}
+# life_stage values meaning "no life-stage filter"
+_ALL_LIFE_STAGES = frozenset(("all", "All", "ALL"))
+
+
+def _normalize_species(species: str) -> str:
+    return _SPECIES_MAP.get(species) or _SPECIES_MAP.get(species.lower(), "Dog")
+
+
+# search_products_tool filter key -> OpenSearch field for exact-match term filters
+_TERM_FIELDS = {
+    key: key for key in (
+        "food_type", "flavour", "brand", "breed", "categories", "country_of_origin",
+        "discount_type", "manufacturer", "model", "pack_size", "shelf_life",
+        "storage_info", "safety_info", "uom",
+    )
+}
+
+# filter key -> (field, range operator, coercion); applied only when the value is > 0
+_RANGE_FIELDS = {
+    "discount_value": ("discount_value", "gte", float),
+    "rating": ("rating", "gte", float),
+    "availability_stock_qty": ("availability.stock_qty", "gte", int),
+    "availability_lead_time_days": ("availability.lead_time_days", "lte", int),
+}
+
+# filter key -> boolean field; applied whenever the key is present and not null
+_FLAG_FIELDS = {
+    "availability_in_stock": "availability.in_stock",
+    "availability_backorderable": "availability.backorderable",
+}
+
+
+# Product fields returned to the agent; requested via _source.includes so OpenSearch
+# never ships embeddings, searchable_text or any other unused field
+_RESULT_FIELDS = (
+    "title", "brand", "breed", "categories", "country_of_origin", "description",
+    "dimensions", "discount_type", "discount_value", "flavour", "food_type", "gtin",
+    "image_url_primary", "ingredients", "life_stage", "manufacturer", "model", "mpn",
+    "num_reviews", "pack_size", "price", "price_list", "price_mrp", "price_sale",
+    "product_id", "product_url", "qty_available", "rating", "safety_info", "shelf_life",
+    "sku", "species", "storage_info", "subtitle", "synonyms", "tags", "uom", "variant_id",
+    "availability",
+)
+
+
+_CSV_RE = re.compile(r"\s*,\s*")
+
+
+def _csv_list(value: str) -> List[str]:
+    return [t for t in _CSV_RE.split(value.strip()) if t] if value else []
+
+
+@lru_cache(maxsize=512)
+def _build_search_body(query: str, species: str, filters: str):
     """
-    Flexible search function - executes query with provided parameters.
-    The LLM handles the search strategy and fallback logic.
+    Build the OpenSearch body for one tool call.
+
+    Memoized on the raw tool arguments because the agent's gradual refinement
+    repeats the same (query, species, filters) often; callers must treat the
+    returned body as read-only.
+
+    Returns:
+        (search_body, qtext, page, size)
     """
-    logger.info(f"Tool called: search_products_tool with species='{species}', query='{query}', filters='{filters}'")
-    
-    # OpenSearch configuration
-    OS_HOST = os.getenv("OS_HOST", "localhost")
-    OS_PORT = os.getenv("OS_PORT", "9200")
-    OS_USER = os.getenv("OS_USER", "admin")
-    OS_PASS = os.getenv("OS_PASS", "YourStrongP@ssw0rd!")
-    OS_INDEX = os.getenv("OS_INDEX", "products_pets_v3")
-    
     # Parse filters JSON
     try:
         filter_dict = json.loads(filters) if filters else {}
@@ -64,89 +220,39 @@ def search_products_tool(
         logger.warning(f"Invalid filters JSON: {filters}, using empty filters")
         filter_dict = {}
     
-    # Extract parameters from filters with defaults
     life_stage = filter_dict.get("life_stage", "")
-    food_type = filter_dict.get("food_type", "")
-    flavour = filter_dict.get("flavour", "")
-    brand = filter_dict.get("brand", "")
     breed = filter_dict.get("breed", "")
-    categories = filter_dict.get("categories", "")
-    country_of_origin = filter_dict.get("country_of_origin", "")
-    discount_type = filter_dict.get("discount_type", "")
-    discount_value = float(filter_dict.get("discount_value", 0.0))
-    manufacturer = filter_dict.get("manufacturer", "")
-    model = filter_dict.get("model", "")
-    pack_size = filter_dict.get("pack_size", "")
-    price_min = float(filter_dict.get("price_min", 0.0))
-    price_max = float(filter_dict.get("price_max", 0.0))
-    rating = float(filter_dict.get("rating", 0.0))
-    tags = filter_dict.get("tags", "")
-    tags_any = filter_dict.get("tags_any", "")
-    exclude_ingredients = filter_dict.get("exclude_ingredients", "")
-    breed_soft = filter_dict.get("breed_soft", "")
-    availability_in_stock = filter_dict.get("availability_in_stock", None)
-    availability_backorderable = filter_dict.get("availability_backorderable", None)
-    availability_stock_qty = int(filter_dict.get("availability_stock_qty", 0))
-    availability_lead_time_days = int(filter_dict.get("availability_lead_time_days", 0))
-    shelf_life = filter_dict.get("shelf_life", "")
-    storage_info = filter_dict.get("storage_info", "")
-    safety_info = filter_dict.get("safety_info", "")
-    uom = filter_dict.get("uom", "")
-    dimensions_size_unit = filter_dict.get("dimensions_size_unit", "")
-    dimensions_size_value = float(filter_dict.get("dimensions_size_value", 0.0))
-    dimensions_volume_unit = filter_dict.get("dimensions_volume_unit", "")
-    dimensions_volume_value = float(filter_dict.get("dimensions_volume_value", 0.0))
-    dimensions_weight_unit = filter_dict.get("dimensions_weight_unit", "")
-    dimensions_weight_value = float(filter_dict.get("dimensions_weight_value", 0.0))
     page = int(filter_dict.get("page", 1))
     size = int(filter_dict.get("size", 3))
     
     # Normalize species
-    sp = species.title() if species.lower() in ["dog", "cat"] else "Dog"
+    sp = _normalize_species(species)
     
     # Build simple query with provided parameters
-    must, should, filt, must_not = [], [], [], []
+    should, filt, must_not = [], [], []
     
     # Species filter (required)
     filt.append({"term": {"species": sp}})
     
-    # Add other filters if provided
-    if life_stage and life_stage.lower() != "all":
+    if life_stage and life_stage not in _ALL_LIFE_STAGES:
         filt.append({"terms": {"life_stage": [life_stage, "All"]}})
     
-    if food_type:
-        filt.append({"term": {"food_type": food_type}})
-        
-    if flavour:
-        filt.append({"term": {"flavour": flavour}})
-        
-    if brand:
-        filt.append({"term": {"brand": brand}})
-        
-    if breed:
-        filt.append({"term": {"breed": breed}})
-        
-    if categories:
-        filt.append({"term": {"categories": categories}})
-        
-    if country_of_origin:
-        filt.append({"term": {"country_of_origin": country_of_origin}})
-        
-    if discount_type:
-        filt.append({"term": {"discount_type": discount_type}})
-        
-    if discount_value > 0:
-        filt.append({"range": {"discount_value": {"gte": discount_value}}})
-        
-    if manufacturer:
-        filt.append({"term": {"manufacturer": manufacturer}})
-        
-    if model:
-        filt.append({"term": {"model": model}})
-        
-    if pack_size:
-        filt.append({"term": {"pack_size": pack_size}})
-        
+    # Table-driven filters: only keys the caller actually sent are looked at
+    for key, value in filter_dict.items():
+        if key in _TERM_FIELDS:
+            if value:
+                filt.append({"term": {_TERM_FIELDS[key]: value}})
+        elif key in _RANGE_FIELDS:
+            field, op, coerce = _RANGE_FIELDS[key]
+            num = coerce(value)
+            if num > 0:
+                filt.append({"range": {field: {op: num}}})
+        elif key in _FLAG_FIELDS:
+            if value is not None:
+                filt.append({"term": {_FLAG_FIELDS[key]: value}})
+    
+    price_min = float(filter_dict.get("price_min", 0.0))
+    price_max = float(filter_dict.get("price_max", 0.0))
     if price_min > 0 or price_max > 0:
         price_range = {}
         if price_min > 0:
@@ -154,86 +260,74 @@ def search_products_tool(
         if price_max > 0:
             price_range["lte"] = price_max
         filt.append({"range": {"price_sale": price_range}})
-        
-    if rating > 0:
-        filt.append({"range": {"rating": {"gte": rating}}})
-        
-    if tags:
-        tags_list = [x.strip() for x in tags.split(",") if x.strip()]
-        if tags_list:
-            should.append({"terms": {"tags": tags_list}})
-        
-    if tags_any:
-        tags_list = [x.strip() for x in tags_any.split(",") if x.strip()]
+    
+    for key in ("tags", "tags_any"):
+        tags_list = _csv_list(filter_dict.get(key, ""))
         if tags_list:
             should.append({"terms": {"tags": tags_list}})
-            
-    if exclude_ingredients:
-        excl_list = [x.strip() for x in exclude_ingredients.split(",") if x.strip()]
+    
+    # Hard tag constraint: filter context is cached by OpenSearch and skips scoring
+    filt.extend({"term": {"tags": t}} for t in _csv_list(filter_dict.get("tags_must", "")))
+    
+    excl_list = _csv_list(filter_dict.get("exclude_ingredients", ""))
+    if excl_list and EXCLUDE_INGREDIENTS_FIELD:
+        # One terms lookup on the keyword subfield instead of N phrase queries
+        must_not.append({"terms": {EXCLUDE_INGREDIENTS_FIELD: excl_list}})
+    else:
         for ex in excl_list:
             must_not.append({"match_phrase": {"ingredients": ex}})
-            
-    if breed_soft:
+    
+    breed_soft = filter_dict.get("breed_soft", "")
+    if breed_soft and not breed:
+        # An exact breed filter already constrains the hits; the soft boost is redundant
         should.append({"match": {"searchable_text": {"query": breed_soft, "operator": "or"}}})
-        
-    # Availability filters
-    if availability_in_stock is not None:
-        filt.append({"term": {"availability.in_stock": availability_in_stock}})
-        
-    if availability_backorderable is not None:
-        filt.append({"term": {"availability.backorderable": availability_backorderable}})
-        
-    if availability_stock_qty > 0:
-        filt.append({"range": {"availability.stock_qty": {"gte": availability_stock_qty}}})
-        
-    if availability_lead_time_days > 0:
-        filt.append({"range": {"availability.lead_time_days": {"lte": availability_lead_time_days}}})
-        
-    # Product info filters
-    if shelf_life:
-        filt.append({"term": {"shelf_life": shelf_life}})
-        
-    if storage_info:
-        filt.append({"term": {"storage_info": storage_info}})
-        
-    if safety_info:
-        filt.append({"term": {"safety_info": safety_info}})
-        
-    if uom:
-        filt.append({"term": {"uom": uom}})
-        
-    # Dimension filters
-    if dimensions_size_unit and dimensions_size_value > 0:
-        filt.append({"term": {"dimensions.size_unit": dimensions_size_unit}})
-        filt.append({"range": {"dimensions.size_value": {"gte": dimensions_size_value}}})
-        
-    if dimensions_volume_unit and dimensions_volume_value > 0:
-        filt.append({"term": {"dimensions.volume_unit": dimensions_volume_unit}})
-        filt.append({"range": {"dimensions.volume_value": {"gte": dimensions_volume_value}}})
-        
-    if dimensions_weight_unit and dimensions_weight_value > 0:
-        filt.append({"term": {"dimensions.weight_unit": dimensions_weight_unit}})
-        filt.append({"range": {"dimensions.weight_value": {"gte": dimensions_weight_value}}})
+    
+    # Dimension filters need both the unit and a positive value
+    for dim in ("size", "volume", "weight"):
+        unit = filter_dict.get(f"dimensions_{dim}_unit", "")
+        value = float(filter_dict.get(f"dimensions_{dim}_value", 0.0))
+        if unit and value > 0:
+            filt.append({"term": {f"dimensions.{dim}_unit": unit}})
+            filt.append({"range": {f"dimensions.{dim}_value": {"gte": value}}})
     
     # Build query text
     if not query.strip():
         query_parts = [f"best food for {sp.lower()}"]
-        if life_stage and life_stage.lower() != "all":
+        if life_stage and life_stage not in _ALL_LIFE_STAGES:
             query_parts.append(life_stage)
         qtext = " ".join(query_parts)
     else:
         qtext = query.strip()
     
-    # Simple text search
-    text_queries = [
-        {"multi_match": {"query": qtext, "fields": ["title^2", "description", "searchable_text"], "type": "best_fields", "fuzziness": "AUTO"}},
-        {"match": {"searchable_text": {"query": qtext, "operator": "or"}}}
-    ]
+    # The agent only shows the top 2-3 hits, so totals are counted just far enough
+    # for "there are plenty" instead of making every shard enumerate all matches
+    track_total_hits = max(size * 10, 100)
+    
+    # Pure filter mode: no user text and no soft boosts, so there is nothing worth
+    # scoring; let the filter cache select hits and rank by rating instead of _score
+    if not query.strip() and not should:
+        search_body = {
+            "query": {"bool": {"filter": filt, "must_not": must_not}},
+            "size": size,
+            "from": (page - 1) * size,
+            "sort": [
+                {"rating": {"order": "desc", "missing": "_last"}},
+                {"num_reviews": {"order": "desc", "missing": "_last"}}
+            ],
+            "track_total_hits": track_total_hits,
+            "_source": {"includes": list(_RESULT_FIELDS)}
+        }
+        return search_body, qtext, page, size
+    
+    # Simple text search (searchable_text is already one of the multi_match fields, so
+    # no separate match clause; no fuzzy expansion for tokens under 4 characters)
+    text_query = {"multi_match": {"query": qtext, "fields": ["title^2", "description", "searchable_text"],
+                                  "type": "best_fields", "tie_breaker": 0.2, "fuzziness": "AUTO:4,7"}}
     
     # Build final query
     bool_query = {
         "bool": {
-            "should": text_queries + should,
+            "should": [text_query] + should,
             "filter": filt,
             "must_not": must_not
         }
@@ -245,121 +339,205 @@ def search_products_tool(
         "size": size,
         "from": (page - 1) * size,
         "sort": [{"_score": {"order": "desc"}}],
-        "_source": {
-            "excludes": ["embedding_product", "searchable_text", "updated_at", "embeddings"]
-        }
+        "track_total_hits": track_total_hits,
+        "_source": {"includes": list(_RESULT_FIELDS)}
     }
     
+    return search_body, qtext, page, size
+
+# The opening search of nearly every conversation is species only (no query text,
+# no filters); its bodies are built once at import
+_SPECIES_ONLY_PLANS = {sp: _build_search_body("", sp, "{}") for sp in ("Dog", "Cat")}
+
+
+def _search_plan(query: str, species: str, filters: str):
+    """(search_body, qtext, page, size) for a tool call, skipping the builder on the species-only path."""
+    if not query.strip() and filters.strip() in ("", "{}"):
+        return _SPECIES_ONLY_PLANS[_normalize_species(species)]
+    return _build_search_body(query, species, filters)
+
+
+def _format_search_results(data: Dict[str, Any], qtext: str, page: int, size: int) -> Dict[str, Any]:
+    """Turn one OpenSearch search response into the tool's result payload."""
+    hits = data.get("hits", {})
+    total = hits.get("total", {}).get("value", 0)
+    hit_list = hits.get("hits") or []
+    
+    logger.info(f"OpenSearch found {total} total results, returning {len(hit_list)} hits")
+    
+    if hit_list:
+        # _source already arrives projected to _RESULT_FIELDS, so each hit is passed
+        # through with its score attached
+        results = [{**hit["_source"], "score": hit.get("_score", 0)} for hit in hit_list]
+        logger.info(f"Returning {len(results)} results to agent")
+    else:
+        results = []
+    
+    return {
+        "results": results,
+        "total": total,
+        "page": page,
+        "size": size,
+        "mode": "simple_bm25",
+        "query": qtext
+    }
+
+
+@lru_cache(maxsize=128)
+def _empty_search_json(qtext: str, page: int, size: int, total: int) -> str:
+    """Encoded tool payload for a search with no hits on this page; negative searches repeat a lot."""
+    logger.info(f"OpenSearch found {total} total results, returning 0 hits")
+    return _dumps({
+        "results": [],
+        "total": total,
+        "page": page,
+        "size": size,
+        "mode": "simple_bm25",
+        "query": qtext
+    })
+
+
+def _search_error(page: int, size: int, error: str) -> Dict[str, Any]:
+    return {
+        "results": [],
+        "total": 0,
+        "page": page,
+        "size": size,
+        "mode": "error",
+        "error": error
+    }
+
+
+# Tool descriptions shown to the model
+_SEARCH_TOOL_DESC = "Search pet products using OpenSearch. Parameters: query (string; free-text search query), species (Dog|Cat; required), filters (JSON string with any combination of: life_stage, food_type, flavour, brand, breed, categories, country_of_origin, discount_type, discount_value, manufacturer, model, pack_size, price_min, price_max, rating, tags, tags_any, tags_must, exclude_ingredients, breed_soft, availability_in_stock, availability_backorderable, availability_stock_qty, availability_lead_time_days, shelf_life, storage_info, safety_info, uom, dimensions_size_unit, dimensions_size_value, dimensions_volume_unit, dimensions_volume_value, dimensions_weight_unit, dimensions_weight_value, page, size). Returns JSON with results, total, page, size, and mode."
+_SEARCH_BATCH_TOOL_DESC = "Run several product searches in ONE OpenSearch round trip. Parameters: queries (JSON array string; each item is an object with query, species (Dog|Cat) and filters (object or JSON string with the same keys as search_products_tool)). Returns a JSON array with one search_products_tool-style result per item, in input order."
+
+
+@function_tool(description_override=_SEARCH_TOOL_DESC)
+async def search_products_tool(
+    query: str,
+    species: str,
+    filters: str = "{}"
+) -> str:
+    """
+    Flexible search function - executes query with provided parameters.
+    The LLM handles the search strategy and fallback logic.
+    """
+    logger.info(f"Tool called: search_products_tool with species='{species}', query='{query}', filters='{filters}'")
+    
+    # Identical searches within SEARCH_CACHE_TTL reuse the earlier answer without
+    # building a body or calling OpenSearch
+    cache_key = (query, species, filters)
+    cached = _search_cache_get(cache_key)
+    if cached is not None:
+        logger.info("Returning cached search results")
+        return cached
+    
+    search_body, qtext, page, size = _search_plan(query, species, filters)
+    
     try:
         # Make request to OpenSearch (using HTTPS)
-        url = f"https://{OS_HOST}:{OS_PORT}/{OS_INDEX}/_search"
-        auth = (OS_USER, OS_PASS)
+        path = f"/{OS_INDEX}/_search"
         
-        logger.info(f"Making OpenSearch request to: {url}")
-        logger.info(f"Search body: {json.dumps(search_body, indent=2)}")
+        logger.info(f"Making OpenSearch request to: {_OS_CLIENT.base_url}{path}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Search body: %s", _dumps(search_body))
         
-        response = httpx.post(url, json=search_body, auth=auth, timeout=30, verify=False)
+        response = await _OS_CLIENT.post(path, json=search_body)
         logger.info(f"OpenSearch response status: {response.status_code}")
         
         response.raise_for_status()
         
-        data = response.json()
-        logger.info(f"OpenSearch response data: {json.dumps(data, indent=2)}")
+        data = _loads(response.content)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("OpenSearch response data: %s", _dumps(data))
         
         hits = data.get("hits", {})
-        total = hits.get("total", {}).get("value", 0)
-        
-        logger.info(f"OpenSearch found {total} total results, returning {len(hits.get('hits', []))} hits")
-        
-        results = []
-        for hit in hits.get("hits", []):
-            source = hit["_source"]
-            # Return all fields except embeddings, searchable_text, and updated_at
-            result = {
-                "title": source.get("title", ""),
-                "brand": source.get("brand", ""),
-                "breed": source.get("breed", ""),
-                "categories": source.get("categories", ""),
-                "country_of_origin": source.get("country_of_origin", ""),
-                "description": source.get("description", ""),
-                "dimensions": source.get("dimensions", {}),
-                "discount_type": source.get("discount_type", ""),
-                "discount_value": source.get("discount_value", 0),
-                "flavour": source.get("flavour", ""),
-                "food_type": source.get("food_type", ""),
-                "gtin": source.get("gtin", ""),
-                "image_url_primary": source.get("image_url_primary", ""),
-                "ingredients": source.get("ingredients", ""),
-                "life_stage": source.get("life_stage", ""),
-                "manufacturer": source.get("manufacturer", ""),
-                "model": source.get("model", ""),
-                "mpn": source.get("mpn", ""),
-                "num_reviews": source.get("num_reviews", 0),
-                "pack_size": source.get("pack_size", ""),
-                "price": source.get("price", {}),
-                "price_list": source.get("price_list", 0),
-                "price_mrp": source.get("price_mrp", 0),
-                "price_sale": source.get("price_sale", 0),
-                "product_id": source.get("product_id", ""),
-                "product_url": source.get("product_url", ""),
-                "qty_available": source.get("qty_available", 0),
-                "rating": source.get("rating", 0),
-                "safety_info": source.get("safety_info", ""),
-                "shelf_life": source.get("shelf_life", ""),
-                "sku": source.get("sku", ""),
-                "species": source.get("species", ""),
-                "storage_info": source.get("storage_info", ""),
-                "subtitle": source.get("subtitle", ""),
-                "synonyms": source.get("synonyms", []),
-                "tags": source.get("tags", []),
-                "uom": source.get("uom", ""),
-                "variant_id": source.get("variant_id", ""),
-                "availability": source.get("availability", {}),
-                "score": hit.get("_score", 0)
-            }
-            results.append(result)
+        if not hits.get("hits"):
+            # No hits: reuse the encoded empty payload and remember the miss on any page
+            out = _empty_search_json(qtext, page, size, hits.get("total", {}).get("value", 0))
+            _search_cache_put(cache_key, out)
+            return out
         
-        logger.info(f"Returning {len(results)} results to agent")
-        
-        return json.dumps({
-            "results": results,
-            "total": total,
-            "page": page,
-            "size": size,
-            "mode": "simple_bm25",
-            "query": qtext
-        }, ensure_ascii=False)
+        out = _dumps(_format_search_results(data, qtext, page, size))
+        if page == 1:
+            _search_cache_put(cache_key, out)
+        return out
         
     except Exception as e:
         logger.error(f"Search error: {e}")
-        return json.dumps({
-            "results": [],
-            "total": 0,
-            "page": page,
-            "size": size,
-            "mode": "error",
-            "error": str(e)
-        }, ensure_ascii=False)
+        return _dumps(_search_error(page, size, str(e)))
 
-# =============================================================================
-# PET ASSISTANT AGENT CONFIGURATION
-# =============================================================================
 
-def create_pet_assistant() -> Agent[AgentContext]:
+@function_tool(description_override=_SEARCH_BATCH_TOOL_DESC)
+async def search_products_batch_tool(queries: str) -> str:
     """
-    Create and configure the pet food assistant agent.
-    
-    Returns:
-        Agent[AgentContext]: Configured pet assistant agent
+    Batch variant of search_products_tool: every query goes out in a single
+    _msearch request instead of one HTTPS round trip each.
     """
-    logger.info("Creating pet food assistant agent")
+    logger.info(f"Tool called: search_products_batch_tool with queries='{queries}'")
     
-    def dynamic_instructions(context, agent) -> str:
-        """Generate instructions with username context."""
-        # context is RunContextWrapper, context.context is AgentContext, context.context.request_context is our dict
-        username = context.context.request_context.get("username", "there") if context.context.request_context else "there"
-        
-        return f"""
+    try:
+        specs = json.loads(queries) if queries else []
+        if not isinstance(specs, list):
+            raise ValueError("queries must be a JSON array")
+    except (json.JSONDecodeError, ValueError) as e:
+        logger.warning(f"Invalid batch queries: {queries}")
+        return _dumps([_search_error(1, 3, f"Invalid queries: {e}")])
+    
+    # Build every body first; items that fail keep their slot as an error
+    plans: List[Any] = []
+    lines: List[str] = []
+    for spec in specs:
+        try:
+            filters = spec.get("filters") or "{}"
+            if not isinstance(filters, str):
+                filters = json.dumps(filters, sort_keys=True)
+            plan = _search_plan(spec.get("query") or "", spec.get("species") or "Dog", filters)
+        except Exception as e:
+            plans.append(str(e))
+            continue
+        plans.append(plan)
+        lines.append("{}")
+        lines.append(json.dumps(plan[0]))
+    
+    out: List[Dict[str, Any]] = []
+    try:
+        responses: List[Dict[str, Any]] = []
+        if lines:
+            response = await _OS_CLIENT.post(
+                f"/{OS_INDEX}/_msearch",
+                content="\n".join(lines) + "\n",
+                headers={"Content-Type": "application/x-ndjson"},
+            )
+            logger.info(f"OpenSearch _msearch response status: {response.status_code}")
+            response.raise_for_status()
+            responses = _loads(response.content).get("responses", [])
+        
+        it = iter(responses)
+        for plan in plans:
+            if isinstance(plan, str):
+                out.append(_search_error(1, 3, plan))
+                continue
+            _, qtext, page, size = plan
+            res = next(it, {"error": "missing _msearch response"})
+            if "error" in res:
+                out.append(_search_error(page, size, str(res["error"])))
+            else:
+                out.append(_format_search_results(res, qtext, page, size))
+    except Exception as e:
+        logger.error(f"Batch search error: {e}")
+        out = [_search_error(1, 3, str(e)) if isinstance(plan, str) else _search_error(plan[2], plan[3], str(e))
+               for plan in plans]
+    
+    return _dumps(out)
+
+# =============================================================================
+# PET ASSISTANT AGENT CONFIGURATION
+# =============================================================================
+
+# Instruction template; only {username} varies between turns ({{ }} are literal braces)
+_INSTRUCTIONS_TEMPLATE = """
 
 # Role and Objective
 Be a warm, knowledgeable Pet Food Sales Assistant (Aya) for a store specialising in dog and cat food. Your goals:
@@ -444,6 +622,9 @@ Be a warm, knowledgeable Pet Food Sales Assistant (Aya) for a store specialising
   - query: descriptive string (e.g., "grain-free adult dog food")
   - species: "Dog" or "Cat" (REQUIRED)
   - filters: JSON string with any combination of available filters
+- **Batching**: When you already know you want several searches at once (e.g. a few filter
+  combinations to compare), call search_products_batch_tool(queries) with a JSON array of
+  {{"query", "species", "filters"}} objects instead of calling search_products_tool repeatedly.
 - **Progressive Search Approach**: Start with minimal filters and gradually add more:
   - First search: query + species + empty filters JSON
   - Second search: query + species + {{"life_stage": "adult"}}
@@ -466,6 +647,7 @@ Be a warm, knowledgeable Pet Food Sales Assistant (Aya) for a store specialising
   - rating: minimum rating (numeric)
   - tags: specific tags (comma-separated)
   - tags_any: "Grain Free", "Natural", "Organic" (comma-separated)
+  - tags_must: tags every result must have (comma-separated; hard filter)
   - exclude_ingredients: ingredients to avoid (comma-separated)
   - breed_soft: breed name for soft matching
   - availability_in_stock: true/false for stock availability
@@ -492,7 +674,8 @@ Be a warm, knowledgeable Pet Food Sales Assistant (Aya) for a store specialising
 - life_stage: "puppy", "kitten", "adult", "senior", or "All" (keyword field)
 - food_type: "dry", "wet", "treats", etc. (keyword field)
 - flavour: "chicken", "salmon", "beef", etc. (keyword field)
-- tags_any: "Grain Free", "Natural", "Organic", etc. (keyword field)
+- tags_any: "Grain Free", "Natural", "Organic", etc. (keyword field, boosts ranking)
+- tags_must: same values as tags_any, but results must carry every listed tag
 - price_min/price_max: numeric range on price_sale field
 - exclude_ingredients: comma-separated phrases to exclude from ingredients text
 - breed_soft: soft match in searchable_text (optional)
@@ -504,7 +687,7 @@ Be a warm, knowledgeable Pet Food Sales Assistant (Aya) for a store specialising
   - Hard includes: "must", "only", "strictly" → required filters
   - Soft boosts: "prefer", "usually likes" → reflect in query/non-hard filters
   - Map to search params and re-run immediately:
-    - Grain-free → tags_any: "Grain Free"
+    - Grain-free → tags_any: "Grain Free" (strictly grain-free → tags_must: "Grain Free")
     - No chicken/corn/soy → exclude_ingredients: "chicken,corn,soy"
     - Fish only/prefer fish → flavour: salmon/tuna/ocean fish
     - Wet only/dry only → food_type: "wet" or "dry"
@@ -547,12 +730,35 @@ Be a warm, knowledgeable Pet Food Sales Assistant (Aya) for a store specialising
    User: "Yes, that's right. He's about 3 years old."
    Assistant: "Perfect! Let me find some great adult dog food options for your Golden Retriever..." [searches with search_products_tool("adult Golden Retriever dog food", "Dog", '{{"life_stage": "adult", "breed": "Golden Retriever"}}')]
 """
+
+
+@lru_cache(maxsize=128)
+def _instructions_for(username: str) -> str:
+    """Render the agent instructions once per username instead of on every turn."""
+    return _INSTRUCTIONS_TEMPLATE.format(username=username)
+
+
+def create_pet_assistant() -> Agent[AgentContext]:
+    """
+    Create and configure the pet food assistant agent.
+    
+    Returns:
+        Agent[AgentContext]: Configured pet assistant agent
+    """
+    logger.info("Creating pet food assistant agent")
+    
+    def dynamic_instructions(context, agent) -> str:
+        """Generate instructions with username context."""
+        # context is RunContextWrapper, context.context is AgentContext, context.context.request_context is our dict
+        username = context.context.request_context.get("username", "there") if context.context.request_context else "there"
+        
+        return _instructions_for(username)
     
     agent = Agent[AgentContext](
         name="aya_pet_food_assistant",
         instructions=dynamic_instructions,
         model="gpt-5",
-        tools=[search_products_tool],
+        tools=[search_products_tool, search_products_batch_tool],
         model_settings=ModelSettings(
             store=True,
             reasoning=Reasoning(
@@ -2,17 +2,46 @@
 
 # server.py
 import os
-import requests
 import json
+import time
+import base64
+import hashlib
+from collections import OrderedDict
 import httpx
 from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict, field_validator
 from typing import Optional, List, Any
 import logging
 
 # Import OpenAI client for Prompt API
 from openai import OpenAI
 
+try:
+    # C-speed JSON parsing for filters and OpenSearch responses; stdlib json otherwise
+    import orjson  # type: ignore
+except ImportError:
+    orjson = None
+
+def _loads(data):
+    return orjson.loads(data) if orjson is not None else json.loads(data)
+
+def _dumps_bytes(obj) -> bytes:
+    """Request bodies as UTF-8 JSON bytes, passed to httpx via content=."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode("utf-8")
+
+def _body_key(obj) -> bytes:
+    """Stable digest of a search body (sorted keys) for the result cache."""
+    if orjson is not None:
+        raw = orjson.dumps(obj, option=orjson.OPT_SORT_KEYS)
+    else:
+        raw = json.dumps(obj, sort_keys=True).encode("utf-8")
+    return hashlib.blake2b(raw, digest_size=16).digest()
+
+_JSON_HEADERS = {"Content-Type": "application/json"}
+_NDJSON_HEADERS = {"Content-Type": "application/x-ndjson"}
+
 logger = logging.getLogger("chatkit")
 logging.basicConfig(level=logging.INFO)
 
@@ -44,110 +73,247 @@ OS_PORT = os.getenv("OS_PORT", "9200")
 OS_USER = os.getenv("OS_USER", "admin")
 OS_PASS = os.getenv("OS_PASS", "YourStrongP@ssw0rd!")
 OS_INDEX = os.getenv("OS_INDEX", "products_pets_v3")
+OS_SEARCH_URL = f"https://{OS_HOST}:{OS_PORT}/{OS_INDEX}/_search"
+OS_MSEARCH_URL = f"https://{OS_HOST}:{OS_PORT}/{OS_INDEX}/_msearch"
+OS_AUTH = httpx.BasicAuth(OS_USER, OS_PASS)
+
+try:
+    import h2  # noqa: F401 - httpx needs it for HTTP/2
+    _HTTP2 = True
+except ImportError:
+    _HTTP2 = False
 
 # Initialize OpenAI client for Prompt API
 openai_client = OpenAI(api_key=OPENAI_API_KEY)
 
+# Static headers for the ChatKit / Realtime session calls to api.openai.com
+_OPENAI_HEADERS = {
+    "Authorization": f"Bearer {OPENAI_API_KEY}",
+    "Content-Type": "application/json",
+}
+_CHATKIT_HEADERS = {**_OPENAI_HEADERS, "OpenAI-Beta": "chatkit_beta=v1"}
+
 # =============================================================================
 # OPENSEARCH SEARCH FUNCTION (matching Python agent)
 # =============================================================================
 
-async def search_products_opensearch(query: str, species: str, filters: str = "{}") -> dict:
+# Species spellings the agents send, resolved with one dict lookup; anything else is
+# folded with lower() and unknown species default to Dog
+_SPECIES_MAP = {"dog": "Dog", "Dog": "Dog", "DOG": "Dog", "cat": "Cat", "Cat": "Cat", "CAT": "Cat"}
+# life_stage values meaning "no life-stage filter"
+_ALL_LIFE_STAGES = frozenset(("all", "All", "ALL"))
+
+def _normalize_species(species: str) -> str:
+    return _SPECIES_MAP.get(species) or _SPECIES_MAP.get(species.lower(), "Dog")
+
+# Filter key -> exact-match term filter on the field of the same name
+_TERM_FIELDS = frozenset((
+    "food_type", "flavour", "brand", "breed", "categories", "country_of_origin",
+    "discount_type", "manufacturer", "model", "pack_size", "shelf_life",
+    "storage_info", "safety_info", "uom",
+))
+
+# Filter key -> (field, range operator, coercion); applied only when the value is > 0
+_RANGE_FIELDS = {
+    "discount_value": ("discount_value", "gte", float),
+    "rating": ("rating", "gte", float),
+    "availability_stock_qty": ("availability.stock_qty", "gte", int),
+    "availability_lead_time_days": ("availability.lead_time_days", "lte", int),
+}
+
+# Filter key -> boolean field; applied whenever the key is present and not null
+_FLAG_FIELDS = {
+    "availability_in_stock": "availability.in_stock",
+    "availability_backorderable": "availability.backorderable",
+}
+
+# Constant body fragments, shared (never mutated) by every search body
+# Every sort ends on _id so tied hits keep one total order on every page, which is
+# what lets a next_token resume exactly where the previous page stopped
+_TIEBREAKER = ({"_id": {"order": "asc"}},)
+_SORT_BY_SCORE = ({"_score": {"order": "desc"}},) + _TIEBREAKER
+_RATING_ORDER = (
+    {"rating": {"order": "desc", "missing": "_last"}},
+    {"num_reviews": {"order": "desc", "missing": "_last"}},
+)
+_SORT_BY_RATING = _RATING_ORDER + _TIEBREAKER
+_SORT_BY_BOOST_THEN_RATING = ({"_score": {"order": "desc"}},) + _RATING_ORDER + _TIEBREAKER
+# Fuzzy matching only on the short title/description fields; searchable_text gets a plain match
+_TEXT_FIELDS = ("title^2", "description")
+
+# Fields returned per hit, in response order, with the default used when a document lacks one
+_HIT_DEFAULTS = {
+    "title": "",
+    "brand": "",
+    "breed": "",
+    "categories": "",
+    "country_of_origin": "",
+    "description": "",
+    "dimensions": {},
+    "discount_type": "",
+    "discount_value": 0,
+    "flavour": "",
+    "food_type": "",
+    "gtin": "",
+    "image_url_primary": "",
+    "ingredients": "",
+    "life_stage": "",
+    "manufacturer": "",
+    "model": "",
+    "mpn": "",
+    "num_reviews": 0,
+    "pack_size": "",
+    "price": {},
+    "price_list": 0,
+    "price_mrp": 0,
+    "price_sale": 0,
+    "product_id": "",
+    "product_url": "",
+    "qty_available": 0,
+    "rating": 0,
+    "safety_info": "",
+    "shelf_life": "",
+    "sku": "",
+    "species": "",
+    "storage_info": "",
+    "subtitle": "",
+    "synonyms": [],
+    "tags": [],
+    "uom": "",
+    "variant_id": "",
+    "availability": {},
+}
+_HIT_KEYS = tuple(_HIT_DEFAULTS)
+# Fetch only the projected fields; embeddings and searchable_text never leave OpenSearch
+_SOURCE_INCLUDES = {"includes": _HIT_KEYS}
+# Response trimming: only the paths _format_search_results reads come back over the wire,
+# so _id/_index/_shards/took and other metadata are never parsed
+_SEARCH_PARAMS = {"filter_path": "hits.total,hits.hits._score,hits.hits._source,hits.hits.sort"}
+_MSEARCH_PARAMS = {"filter_path": "responses.error,responses.hits.total,responses.hits.hits._score,"
+                                  "responses.hits.hits._source,responses.hits.hits.sort"}
+
+def _text_queries(qtext: str) -> list:
+    """Simple text search clauses for the bool.should list."""
+    return [
+        {"multi_match": {"query": qtext, "fields": _TEXT_FIELDS, "type": "best_fields",
+                         "fuzziness": "AUTO", "prefix_length": 2, "max_expansions": 20}},
+        {"match": {"searchable_text": {"query": qtext, "operator": "or"}}}
+    ]
+
+def _encode_cursor(sort_values: list, seen: int) -> str:
+    """Opaque page token: the last hit's sort values (tiebreaker included) and the number
+    of hits returned so far, as URL-safe base64 JSON."""
+    return base64.urlsafe_b64encode(_dumps_bytes({"after": sort_values, "seen": seen})).decode("ascii")
+
+def _decode_cursor(token: str) -> Optional[tuple]:
+    """(sort_values, seen) from a next_token, or None if the token is not one of ours."""
+    try:
+        values = _loads(base64.urlsafe_b64decode(token.encode("ascii")))
+    except ValueError:
+        return None
+    if not isinstance(values, dict) or not isinstance(values.get("after"), list) or not isinstance(values.get("seen"), int):
+        return None
+    return values["after"], values["seen"]
+
+def _csv_list(value: str) -> List[str]:
+    return [x.strip() for x in value.split(",") if x.strip()] if value else []
+
+# Short-lived cache of filter-only search results, keyed by _body_key(search_body).
+# No lock: each get/put is a synchronous OrderedDict operation on the single event loop.
+# get and put are NOT atomic together (the OpenSearch POST is awaited in between), so
+# concurrent misses for the same key may both query and the last put wins.
+SEARCH_CACHE_TTL = float(os.getenv("SEARCH_CACHE_TTL", "30"))  # seconds; 0 disables
+SEARCH_CACHE_SIZE = 512
+_SEARCH_CACHE: "OrderedDict[bytes, tuple]" = OrderedDict()
+
+def _search_cache_get(key: bytes) -> Optional[dict]:
+    if SEARCH_CACHE_TTL <= 0:
+        return None
+    hit = _SEARCH_CACHE.get(key)
+    if hit is None:
+        return None
+    if time.monotonic() - hit[0] >= SEARCH_CACHE_TTL:
+        del _SEARCH_CACHE[key]
+        return None
+    _SEARCH_CACHE.move_to_end(key)
+    return hit[1]
+
+def _search_cache_put(key: bytes, value: dict) -> None:
+    if SEARCH_CACHE_TTL <= 0:
+        return
+    _SEARCH_CACHE[key] = (time.monotonic(), value)
+    _SEARCH_CACHE.move_to_end(key)
+    while len(_SEARCH_CACHE) > SEARCH_CACHE_SIZE:
+        _SEARCH_CACHE.popitem(last=False)
+
+@app.on_event("startup")
+async def open_http_clients():
+    """Create the pooled OpenSearch and OpenAI clients once, so requests reuse keep-alive connections."""
+    # Idle OpenSearch connections stay open for 30s (httpx default: 5s) so voice turns a few
+    # seconds apart reuse the warm TLS session; HTTP/2 multiplexes them when h2 is installed.
+    # retries=1 only retries failed connects, never a request that reached OpenSearch.
+    app.state.os_client = httpx.AsyncClient(
+        auth=OS_AUTH,
+        timeout=httpx.Timeout(30.0),
+        transport=httpx.AsyncHTTPTransport(
+            verify=False,
+            http2=_HTTP2,
+            limits=httpx.Limits(max_keepalive_connections=32, max_connections=64, keepalive_expiry=30.0),
+            retries=1,
+        ),
+    )
+    app.state.openai_http = httpx.AsyncClient(
+        http2=_HTTP2,
+        limits=httpx.Limits(max_keepalive_connections=16, max_connections=32),
+        timeout=httpx.Timeout(30.0),
+    )
+
+@app.on_event("shutdown")
+async def close_http_clients():
+    await app.state.os_client.aclose()
+    await app.state.openai_http.aclose()
+
+def _build_search_body(query: str, species: str, filters: "SearchFilters", search_after: str = "") -> tuple:
     """
-    Direct OpenSearch integration matching the Python agent's search_products_tool function.
+    Build the OpenSearch body for one product search from already-validated filters.
+    Returns (search_body, qtext, page, size, cache_key, offset); cache_key is None when the result
+    is not cacheable, offset is the number of hits before this page.
     """
-    logger.info(f"OpenSearch search: species='{species}', query='{query}', filters='{filters}'")
-    
-    # Parse filters JSON
-    try:
-        filter_dict = json.loads(filters) if filters else {}
-    except json.JSONDecodeError:
-        logger.warning(f"Invalid filters JSON: {filters}, using empty filters")
-        filter_dict = {}
+    # Only the keys that differ from the no-op defaults drive the filter loop below
+    filter_dict = filters.model_dump(exclude_defaults=True)
     
-    # Extract parameters from filters with defaults
     life_stage = filter_dict.get("life_stage", "")
-    food_type = filter_dict.get("food_type", "")
-    flavour = filter_dict.get("flavour", "")
-    brand = filter_dict.get("brand", "")
-    breed = filter_dict.get("breed", "")
-    categories = filter_dict.get("categories", "")
-    country_of_origin = filter_dict.get("country_of_origin", "")
-    discount_type = filter_dict.get("discount_type", "")
-    discount_value = float(filter_dict.get("discount_value", 0.0))
-    manufacturer = filter_dict.get("manufacturer", "")
-    model = filter_dict.get("model", "")
-    pack_size = filter_dict.get("pack_size", "")
-    price_min = float(filter_dict.get("price_min", 0.0))
-    price_max = float(filter_dict.get("price_max", 0.0))
-    rating = float(filter_dict.get("rating", 0.0))
-    tags = filter_dict.get("tags", "")
-    tags_any = filter_dict.get("tags_any", "")
-    exclude_ingredients = filter_dict.get("exclude_ingredients", "")
-    breed_soft = filter_dict.get("breed_soft", "")
-    availability_in_stock = filter_dict.get("availability_in_stock", None)
-    availability_backorderable = filter_dict.get("availability_backorderable", None)
-    availability_stock_qty = int(filter_dict.get("availability_stock_qty", 0))
-    availability_lead_time_days = int(filter_dict.get("availability_lead_time_days", 0))
-    shelf_life = filter_dict.get("shelf_life", "")
-    storage_info = filter_dict.get("storage_info", "")
-    safety_info = filter_dict.get("safety_info", "")
-    uom = filter_dict.get("uom", "")
-    dimensions_size_unit = filter_dict.get("dimensions_size_unit", "")
-    dimensions_size_value = float(filter_dict.get("dimensions_size_value", 0.0))
-    dimensions_volume_unit = filter_dict.get("dimensions_volume_unit", "")
-    dimensions_volume_value = float(filter_dict.get("dimensions_volume_value", 0.0))
-    dimensions_weight_unit = filter_dict.get("dimensions_weight_unit", "")
-    dimensions_weight_value = float(filter_dict.get("dimensions_weight_value", 0.0))
     page = int(filter_dict.get("page", 1))
     size = int(filter_dict.get("size", 3))
     
     # Normalize species
-    sp = species.title() if species.lower() in ["dog", "cat"] else "Dog"
+    sp = _normalize_species(species)
     
     # Build simple query with provided parameters
-    must, should, filt, must_not = [], [], [], []
+    should, filt, must_not = [], [], []
     
     # Species filter (required)
     filt.append({"term": {"species": sp}})
     
-    # Add other filters if provided
-    if life_stage and life_stage.lower() != "all":
+    if life_stage and life_stage not in _ALL_LIFE_STAGES:
         filt.append({"terms": {"life_stage": [life_stage, "All"]}})
     
-    if food_type:
-        filt.append({"term": {"food_type": food_type}})
-        
-    if flavour:
-        filt.append({"term": {"flavour": flavour}})
-        
-    if brand:
-        filt.append({"term": {"brand": brand}})
-        
-    if breed:
-        filt.append({"term": {"breed": breed}})
-        
-    if categories:
-        filt.append({"term": {"categories": categories}})
-        
-    if country_of_origin:
-        filt.append({"term": {"country_of_origin": country_of_origin}})
-        
-    if discount_type:
-        filt.append({"term": {"discount_type": discount_type}})
-        
-    if discount_value > 0:
-        filt.append({"range": {"discount_value": {"gte": discount_value}}})
-        
-    if manufacturer:
-        filt.append({"term": {"manufacturer": manufacturer}})
-        
-    if model:
-        filt.append({"term": {"model": model}})
-        
-    if pack_size:
-        filt.append({"term": {"pack_size": pack_size}})
-        
+    # Table-driven filters: one pass over the keys the caller actually sent
+    for key, value in filter_dict.items():
+        if key in _TERM_FIELDS:
+            if value:
+                filt.append({"term": {key: value}})
+        elif key in _RANGE_FIELDS:
+            field, op, coerce = _RANGE_FIELDS[key]
+            num = coerce(value)
+            if num > 0:
+                filt.append({"range": {field: {op: num}}})
+        elif key in _FLAG_FIELDS:
+            if value is not None:
+                filt.append({"term": {_FLAG_FIELDS[key]: value}})
+    
+    price_min = float(filter_dict.get("price_min", 0.0))
+    price_max = float(filter_dict.get("price_max", 0.0))
     if price_min > 0 or price_max > 0:
         price_range = {}
         if price_min > 0:
@@ -155,237 +321,343 @@ async def search_products_opensearch(query: str, species: str, filters: str = "{
         if price_max > 0:
             price_range["lte"] = price_max
         filt.append({"range": {"price_sale": price_range}})
-        
-    if rating > 0:
-        filt.append({"range": {"rating": {"gte": rating}}})
-        
-    if tags:
-        tags_list = [x.strip() for x in tags.split(",") if x.strip()]
-        if tags_list:
-            should.append({"terms": {"tags": tags_list}})
-        
-    if tags_any:
-        tags_list = [x.strip() for x in tags_any.split(",") if x.strip()]
-        if tags_list:
-            should.append({"terms": {"tags": tags_list}})
-            
-    if exclude_ingredients:
-        excl_list = [x.strip() for x in exclude_ingredients.split(",") if x.strip()]
-        for ex in excl_list:
-            must_not.append({"match_phrase": {"ingredients": ex}})
-            
+    
+    # tags and tags_any both boost on the tags field; send one terms clause for their union
+    tags_union = set(_csv_list(filter_dict.get("tags", ""))) | set(_csv_list(filter_dict.get("tags_any", "")))
+    if tags_union:
+        should.append({"terms": {"tags": sorted(tags_union)}})
+    
+    excludes = [{"match_phrase": {"ingredients": ex}} for ex in _csv_list(filter_dict.get("exclude_ingredients", ""))]
+    if len(excludes) > 4:
+        # One must_not clause instead of many top-level ones
+        must_not.append({"bool": {"should": excludes}})
+    else:
+        must_not.extend(excludes)
+    
+    breed_soft = filter_dict.get("breed_soft", "")
     if breed_soft:
         should.append({"match": {"searchable_text": {"query": breed_soft, "operator": "or"}}})
-        
-    # Availability filters
-    if availability_in_stock is not None:
-        filt.append({"term": {"availability.in_stock": availability_in_stock}})
-        
-    if availability_backorderable is not None:
-        filt.append({"term": {"availability.backorderable": availability_backorderable}})
-        
-    if availability_stock_qty > 0:
-        filt.append({"range": {"availability.stock_qty": {"gte": availability_stock_qty}}})
-        
-    if availability_lead_time_days > 0:
-        filt.append({"range": {"availability.lead_time_days": {"lte": availability_lead_time_days}}})
-        
-    # Product info filters
-    if shelf_life:
-        filt.append({"term": {"shelf_life": shelf_life}})
-        
-    if storage_info:
-        filt.append({"term": {"storage_info": storage_info}})
-        
-    if safety_info:
-        filt.append({"term": {"safety_info": safety_info}})
-        
-    if uom:
-        filt.append({"term": {"uom": uom}})
-        
-    # Dimension filters
-    if dimensions_size_unit and dimensions_size_value > 0:
-        filt.append({"term": {"dimensions.size_unit": dimensions_size_unit}})
-        filt.append({"range": {"dimensions.size_value": {"gte": dimensions_size_value}}})
-        
-    if dimensions_volume_unit and dimensions_volume_value > 0:
-        filt.append({"term": {"dimensions.volume_unit": dimensions_volume_unit}})
-        filt.append({"range": {"dimensions.volume_value": {"gte": dimensions_volume_value}}})
-        
-    if dimensions_weight_unit and dimensions_weight_value > 0:
-        filt.append({"term": {"dimensions.weight_unit": dimensions_weight_unit}})
-        filt.append({"range": {"dimensions.weight_value": {"gte": dimensions_weight_value}}})
+    
+    # Dimension filters need both the unit and a positive value
+    for dim in ("size", "volume", "weight"):
+        unit = filter_dict.get(f"dimensions_{dim}_unit", "")
+        value = float(filter_dict.get(f"dimensions_{dim}_value", 0.0))
+        if unit and value > 0:
+            filt.append({"term": {f"dimensions.{dim}_unit": unit}})
+            filt.append({"range": {f"dimensions.{dim}_value": {"gte": value}}})
     
     # Build query text
     if not query.strip():
         query_parts = [f"best food for {sp.lower()}"]
-        if life_stage and life_stage.lower() != "all":
+        if life_stage and life_stage not in _ALL_LIFE_STAGES:
             query_parts.append(life_stage)
         qtext = " ".join(query_parts)
     else:
         qtext = query.strip()
     
-    # Simple text search
-    text_queries = [
-        {"multi_match": {"query": qtext, "fields": ["title^2", "description", "searchable_text"], "type": "best_fields", "fuzziness": "AUTO"}},
-        {"match": {"searchable_text": {"query": qtext, "operator": "or"}}}
-    ]
-    
-    # Build final query
-    bool_query = {
-        "bool": {
-            "should": text_queries + should,
-            "filter": filt,
-            "must_not": must_not
+    filter_only = not query.strip() and not should
+    if filter_only:
+        # Pure filter mode: nothing worth scoring, so run the filters in constant_score
+        # (cacheable bitsets) and rank by rating like the Python agent does
+        search_body = {
+            "query": {"constant_score": {"filter": {"bool": {"filter": filt, "must_not": must_not}}}},
+            "size": size,
+            "from": (page - 1) * size,
+            "sort": _SORT_BY_RATING,
+            "_source": _SOURCE_INCLUDES
         }
-    }
+    elif not query.strip():
+        # No user text, only soft boosts: the synthetic "best food for ..." text would
+        # just add scoring work, so score on the boosts alone and break ties by rating
+        search_body = {
+            "query": {"bool": {"should": should, "filter": filt, "must_not": must_not}},
+            "size": size,
+            "from": (page - 1) * size,
+            "sort": _SORT_BY_BOOST_THEN_RATING,
+            "_source": _SOURCE_INCLUDES
+        }
+    else:
+        # Build final query
+        bool_query = {
+            "bool": {
+                "should": _text_queries(qtext) + should,
+                "filter": filt,
+                "must_not": must_not
+            }
+        }
+        search_body = {
+            "query": bool_query,
+            "size": size,
+            "from": (page - 1) * size,
+            "sort": _SORT_BY_SCORE,
+            "_source": _SOURCE_INCLUDES
+        }
+    
+    offset = (page - 1) * size
+    if search_after:
+        cursor = _decode_cursor(search_after)
+        if cursor:
+            # Resume after the previous page's last hit; OpenSearch rejects from + search_after
+            del search_body["from"]
+            search_body["search_after"], offset = cursor
+        else:
+            logger.warning(f"Invalid search_after token: {search_after}, using page offset")
+    
+    # Hot filter combinations repeat a lot; free-text queries are too varied to cache
+    cache_key = _body_key(search_body) if filter_only and size <= 20 else None
+    return search_body, qtext, page, size, cache_key, offset
+
+def _format_search_results(data: dict, qtext: str, page: int, size: int, offset: int = 0) -> dict:
+    """Shape one OpenSearch search response into the result dict returned to the agent.
+    offset is the number of hits before this page."""
+    hits = data.get("hits", {})
+    total_info = hits.get("total", {})
+    total = total_info.get("value", 0)
+    hit_list = hits.get("hits", [])
+    
+    logger.info(f"OpenSearch found {total} total results, returning {len(hit_list)} hits")
+    
+    # Hand back a cursor only when hits remain past this page ("gte": total is a lower bound)
+    next_token = None
+    seen = offset + len(hit_list)
+    if hit_list and len(hit_list) >= size and (seen < total or total_info.get("relation") == "gte"):
+        sort_values = hit_list[-1].get("sort")
+        if sort_values:
+            next_token = _encode_cursor(sort_values, seen)
+    
+    results = []
+    for hit in hit_list:
+        source = hit["_source"]
+        # Fixed projection of the returned fields; everything else in _source is ignored
+        result = {k: source.get(k, d) for k, d in _HIT_DEFAULTS.items()}
+        result["score"] = hit.get("_score", 0)
+        results.append(result)
     
-    # Execute search
-    search_body = {
-        "query": bool_query,
+    logger.info(f"Returning {len(results)} results to agent")
+    
+    return {
+        "results": results,
+        "total": total,
+        "page": page,
         "size": size,
-        "from": (page - 1) * size,
-        "sort": [{"_score": {"order": "desc"}}],
-        "_source": {
-            "excludes": ["embedding_product", "searchable_text", "updated_at", "embeddings"]
-        }
+        "mode": "simple_bm25",
+        "query": qtext,
+        "next_token": next_token
+    }
+
+def _search_error(page: int, size: int, error: str) -> dict:
+    return {
+        "results": [],
+        "total": 0,
+        "page": page,
+        "size": size,
+        "mode": "error",
+        "error": error
     }
+
+async def search_products_opensearch(query: str, species: str, filters: Optional["SearchFilters"] = None,
+                                     search_after: str = "") -> dict:
+    """
+    Direct OpenSearch integration matching the Python agent's search_products_tool function.
+    Pass the previous result's next_token as search_after to page without a growing from offset.
+    """
+    if filters is None:
+        filters = SearchFilters()
+    logger.info(f"OpenSearch search: species='{species}', query='{query}', filters='{filters}'")
+    
+    search_body, qtext, page, size, cache_key, offset = _build_search_body(query, species, filters, search_after)
+    if cache_key is not None:
+        cached = _search_cache_get(cache_key)
+        if cached is not None:
+            logger.info("OpenSearch result served from cache")
+            return cached
     
     try:
         # Make request to OpenSearch (using HTTPS)
-        url = f"https://{OS_HOST}:{OS_PORT}/{OS_INDEX}/_search"
-        auth = (OS_USER, OS_PASS)
+        logger.info(f"Making OpenSearch request to: {OS_SEARCH_URL}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Search body: %s", json.dumps(search_body))
         
-        logger.info(f"Making OpenSearch request to: {url}")
-        logger.info(f"Search body: {json.dumps(search_body, indent=2)}")
-        
-        async with httpx.AsyncClient(verify=False) as client:
-            response = await client.post(url, json=search_body, auth=auth, timeout=30)
+        response = await app.state.os_client.post(
+            OS_SEARCH_URL, params=_SEARCH_PARAMS, content=_dumps_bytes(search_body), headers=_JSON_HEADERS
+        )
         
         logger.info(f"OpenSearch response status: {response.status_code}")
         
         response.raise_for_status()
         
-        data = response.json()
-        logger.info(f"OpenSearch response data: {json.dumps(data, indent=2)}")
-        
-        hits = data.get("hits", {})
-        total = hits.get("total", {}).get("value", 0)
-        
-        logger.info(f"OpenSearch found {total} total results, returning {len(hits.get('hits', []))} hits")
-        
-        results = []
-        for hit in hits.get("hits", []):
-            source = hit["_source"]
-            # Return all fields except embeddings, searchable_text, and updated_at
-            result = {
-                "title": source.get("title", ""),
-                "brand": source.get("brand", ""),
-                "breed": source.get("breed", ""),
-                "categories": source.get("categories", ""),
-                "country_of_origin": source.get("country_of_origin", ""),
-                "description": source.get("description", ""),
-                "dimensions": source.get("dimensions", {}),
-                "discount_type": source.get("discount_type", ""),
-                "discount_value": source.get("discount_value", 0),
-                "flavour": source.get("flavour", ""),
-                "food_type": source.get("food_type", ""),
-                "gtin": source.get("gtin", ""),
-                "image_url_primary": source.get("image_url_primary", ""),
-                "ingredients": source.get("ingredients", ""),
-                "life_stage": source.get("life_stage", ""),
-                "manufacturer": source.get("manufacturer", ""),
-                "model": source.get("model", ""),
-                "mpn": source.get("mpn", ""),
-                "num_reviews": source.get("num_reviews", 0),
-                "pack_size": source.get("pack_size", ""),
-                "price": source.get("price", {}),
-                "price_list": source.get("price_list", 0),
-                "price_mrp": source.get("price_mrp", 0),
-                "price_sale": source.get("price_sale", 0),
-                "product_id": source.get("product_id", ""),
-                "product_url": source.get("product_url", ""),
-                "qty_available": source.get("qty_available", 0),
-                "rating": source.get("rating", 0),
-                "safety_info": source.get("safety_info", ""),
-                "shelf_life": source.get("shelf_life", ""),
-                "sku": source.get("sku", ""),
-                "species": source.get("species", ""),
-                "storage_info": source.get("storage_info", ""),
-                "subtitle": source.get("subtitle", ""),
-                "synonyms": source.get("synonyms", []),
-                "tags": source.get("tags", []),
-                "uom": source.get("uom", ""),
-                "variant_id": source.get("variant_id", ""),
-                "availability": source.get("availability", {}),
-                "score": hit.get("_score", 0)
-            }
-            results.append(result)
-        
-        logger.info(f"Returning {len(results)} results to agent")
+        data = _loads(response.content)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("OpenSearch response data: %s", json.dumps(data))
         
-        return {
-            "results": results,
-            "total": total,
-            "page": page,
-            "size": size,
-            "mode": "simple_bm25",
-            "query": qtext
-        }
+        search_result = _format_search_results(data, qtext, page, size, offset)
+        if cache_key is not None:
+            _search_cache_put(cache_key, search_result)
+        return search_result
         
     except Exception as e:
         logger.error(f"Search error: {e}")
-        return {
-            "results": [],
-            "total": 0,
-            "page": page,
-            "size": size,
-            "mode": "error",
-            "error": str(e)
-        }
+        return _search_error(page, size, str(e))
+
+async def search_products_opensearch_batch(searches: List["ProductSearchRequest"]) -> List[dict]:
+    """
+    Batch variant of search_products_opensearch over validated ProductSearchRequests.
+    Cache misses go out together in one _msearch request
+    instead of one HTTPS round trip each; results come back in input order.
+    """
+    logger.info(f"OpenSearch batch search: {len(searches)} searches")
+    
+    # Build every body first; items that fail keep their slot as an error
+    plans: List[Any] = []
+    out: List[Optional[dict]] = []
+    lines: List[bytes] = []
+    for spec in searches:
+        try:
+            plan = _build_search_body(spec.query, spec.species, spec.filters, spec.search_after or "")
+        except Exception as e:
+            plans.append(None)
+            out.append(_search_error(1, 3, str(e)))
+            continue
+        cached = _search_cache_get(plan[4]) if plan[4] is not None else None
+        if cached is not None:
+            plans.append(None)
+            out.append(cached)
+            continue
+        plans.append(plan)
+        out.append(None)
+        lines.append(b"{}")
+        lines.append(_dumps_bytes(plan[0]))
+    
+    if not lines:
+        return out
+    
+    try:
+        response = await app.state.os_client.post(
+            OS_MSEARCH_URL, params=_MSEARCH_PARAMS, content=b"\n".join(lines) + b"\n", headers=_NDJSON_HEADERS
+        )
+        logger.info(f"OpenSearch _msearch response status: {response.status_code}")
+        response.raise_for_status()
+        responses = iter(_loads(response.content).get("responses", []))
+        for i, plan in enumerate(plans):
+            if plan is None:
+                continue
+            search_body, qtext, page, size, cache_key, offset = plan
+            res = next(responses, {"error": "missing _msearch response"})
+            if "error" in res:
+                out[i] = _search_error(page, size, str(res["error"]))
+                continue
+            out[i] = _format_search_results(res, qtext, page, size, offset)
+            if cache_key is not None:
+                _search_cache_put(cache_key, out[i])
+    except Exception as e:
+        logger.error(f"Batch search error: {e}")
+        for i, plan in enumerate(plans):
+            if plan is not None:
+                out[i] = _search_error(plan[2], plan[3], str(e))
+    
+    return out
+
+# Request models are read-only value objects: frozen, unknown keys dropped rather than
+# stored, and no whitespace-stripping pass over every string
+_REQUEST_MODEL_CONFIG = ConfigDict(extra="ignore", frozen=True, str_strip_whitespace=False)
 
 class SessionReq(BaseModel):
+    model_config = _REQUEST_MODEL_CONFIG
     user: str  # your user id or a stable device id
 
 class RealtimeSessionReq(BaseModel):
+    model_config = _REQUEST_MODEL_CONFIG
     model: str = "gpt-4o-realtime-preview-2025-06-03"  # default model
     voice: str = "sage"  # default voice (alloy, echo, sage, shimmer, etc.)
 
+class SearchFilters(BaseModel):
+    """Typed product-search filters; defaults mean "not filtered". Unknown keys are ignored."""
+    model_config = _REQUEST_MODEL_CONFIG
+    life_stage: str = ""
+    food_type: str = ""
+    flavour: str = ""
+    brand: str = ""
+    breed: str = ""
+    categories: str = ""
+    country_of_origin: str = ""
+    discount_type: str = ""
+    discount_value: float = 0.0
+    manufacturer: str = ""
+    model: str = ""
+    pack_size: str = ""
+    price_min: float = 0.0
+    price_max: float = 0.0
+    rating: float = 0.0
+    tags: str = ""  # comma-separated
+    tags_any: str = ""  # comma-separated
+    exclude_ingredients: str = ""  # comma-separated
+    breed_soft: str = ""
+    availability_in_stock: Optional[bool] = None
+    availability_backorderable: Optional[bool] = None
+    availability_stock_qty: int = 0
+    availability_lead_time_days: int = 0
+    shelf_life: str = ""
+    storage_info: str = ""
+    safety_info: str = ""
+    uom: str = ""
+    dimensions_size_unit: str = ""
+    dimensions_size_value: float = 0.0
+    dimensions_volume_unit: str = ""
+    dimensions_volume_value: float = 0.0
+    dimensions_weight_unit: str = ""
+    dimensions_weight_value: float = 0.0
+    page: int = 1
+    size: int = 3
+
 class ProductSearchRequest(BaseModel):
+    model_config = _REQUEST_MODEL_CONFIG
     query: str  # The customer's product query
     species: str  # Required: Dog or Cat
-    filters: str = "{}"  # JSON string with search filters
+    filters: SearchFilters = SearchFilters()  # object, or the JSON string the voice tool sends
+    search_after: Optional[str] = None  # next_token from the previous page, replaces page offsets
+    
+    @field_validator("filters", mode="before")
+    @classmethod
+    def _filters_from_json(cls, value):
+        # The voice agent's tool passes filters as a JSON string; decode it once here
+        if isinstance(value, (str, bytes)):
+            try:
+                return _loads(value) if value.strip() else {}
+            except ValueError:
+                logger.warning(f"Invalid filters JSON: {value}, using empty filters")
+                return {}
+        return value
+
+class ProductSearchBatchRequest(BaseModel):
+    model_config = _REQUEST_MODEL_CONFIG
+    searches: List[ProductSearchRequest]  # e.g. page 1 plus an in-stock variant, run in one _msearch
 
 @app.post("/api/chatkit/session")
-def create_chatkit_session(payload: SessionReq):
+async def create_chatkit_session(payload: SessionReq):
     try:
         logger.info("SESSION start user=%s", payload.user)
         logger.info("Using workflow_id=%s", WORKFLOW_ID)
         
-        response = requests.post(
+        response = await app.state.openai_http.post(
             CHATKIT_API_URL,
-            headers={
-                "Authorization": f"Bearer {OPENAI_API_KEY}",
-                "Content-Type": "application/json",
-                "OpenAI-Beta": "chatkit_beta=v1"
-            },
-            json={
+            headers=_CHATKIT_HEADERS,
+            content=_dumps_bytes({
                 "workflow": {"id": WORKFLOW_ID},
                 "user": payload.user
-            }
+            })
         )
         
         logger.info("OpenAI API response status: %s", response.status_code)
         
-        if not response.ok:
+        if not response.is_success:
             error_detail = response.text
             logger.error("OpenAI API error: %s", error_detail)
             raise HTTPException(status_code=response.status_code, detail=error_detail)
         
-        data = response.json()
+        data = _loads(response.content)
         logger.info("SESSION created successfully, client_secret exists: %s", bool(data.get("client_secret")))
         return {"client_secret": data["client_secret"]}
-    except requests.RequestException as e:
+    except httpx.HTTPError as e:
         logger.error("SESSION creation failed (network error): %s", str(e), exc_info=True)
         raise HTTPException(status_code=500, detail=f"Network error: {str(e)}")
     except Exception as e:
@@ -397,7 +669,7 @@ def create_chatkit_session(payload: SessionReq):
 # =============================================================================
 
 @app.post("/api/realtime/session")
-def create_realtime_session(payload: RealtimeSessionReq = RealtimeSessionReq()):
+async def create_realtime_session(payload: RealtimeSessionReq = RealtimeSessionReq()):
     """
     Creates an ephemeral client secret for OpenAI Realtime API (voice).
     Returns the ephemeral key that the browser uses to establish WebRTC connection.
@@ -407,28 +679,25 @@ def create_realtime_session(payload: RealtimeSessionReq = RealtimeSessionReq()):
         logger.info("REALTIME SESSION start model=%s voice=%s", payload.model, payload.voice)
         
         # Use the CORRECT endpoint per the official SDK docs
-        response = requests.post(
+        response = await app.state.openai_http.post(
             REALTIME_CLIENT_SECRETS_URL,
-            headers={
-                "Authorization": f"Bearer {OPENAI_API_KEY}",
-                "Content-Type": "application/json",
-            },
-            json={
+            headers=_OPENAI_HEADERS,
+            content=_dumps_bytes({
                 "session": {
                     "type": "realtime",
                     "model": "gpt-realtime",
                 }
-            }
+            })
         )
         
         logger.info("OpenAI Realtime API response status: %s", response.status_code)
         
-        if not response.ok:
+        if not response.is_success:
             error_detail = response.text
             logger.error("OpenAI Realtime API error: %s", error_detail)
             raise HTTPException(status_code=response.status_code, detail=error_detail)
         
-        data = response.json()
+        data = _loads(response.content)
         logger.info("REALTIME CLIENT SECRET created successfully")
         logger.info("Response contains 'value': %s", "value" in data)
         
@@ -436,7 +705,7 @@ def create_realtime_session(payload: RealtimeSessionReq = RealtimeSessionReq()):
         # The response format is: { "value": "ek_..." }
         return {"client_secret": data}
         
-    except requests.RequestException as e:
+    except httpx.HTTPError as e:
         logger.error("REALTIME SESSION creation failed (network error): %s", str(e), exc_info=True)
         raise HTTPException(status_code=500, detail=f"Network error: {str(e)}")
     except Exception as e:
@@ -449,32 +718,28 @@ def create_realtime_session(payload: RealtimeSessionReq = RealtimeSessionReq()):
 
 # Optional: refresh endpoint (same call; ChatKit will hit this when token expires)
 @app.post("/api/chatkit/refresh")
-def refresh_chatkit_session(payload: SessionReq):
+async def refresh_chatkit_session(payload: SessionReq):
     try:
         logger.info("REFRESH session for user=%s", payload.user)
         
-        response = requests.post(
+        response = await app.state.openai_http.post(
             CHATKIT_API_URL,
-            headers={
-                "Authorization": f"Bearer {OPENAI_API_KEY}",
-                "Content-Type": "application/json",
-                "OpenAI-Beta": "chatkit_beta=v1"
-            },
-            json={
+            headers=_CHATKIT_HEADERS,
+            content=_dumps_bytes({
                 "workflow": {"id": WORKFLOW_ID},
                 "user": payload.user
-            }
+            })
         )
         
-        if not response.ok:
+        if not response.is_success:
             error_detail = response.text
             logger.error("OpenAI API error on refresh: %s", error_detail)
             raise HTTPException(status_code=response.status_code, detail=error_detail)
         
-        data = response.json()
+        data = _loads(response.content)
         logger.info("REFRESH successful")
         return {"client_secret": data["client_secret"]}
-    except requests.RequestException as e:
+    except httpx.HTTPError as e:
         logger.error("REFRESH failed (network error): %s", str(e), exc_info=True)
         raise HTTPException(status_code=500, detail=f"Network error: {str(e)}")
     except Exception as e:
@@ -492,41 +757,54 @@ async def search_products(payload: ProductSearchRequest):
     The voice agent calls this when customer asks for specific products.
     """
     try:
-        logger.info("=" * 70)
-        logger.info("🔧 PRODUCT SEARCH ENDPOINT HIT")
-        logger.info("=" * 70)
-        logger.info("📥 Received query: %s", payload.query)
-        logger.info("📥 Received species: %s", payload.species)
-        logger.info("📥 Received filters: %s", payload.filters)
-        logger.info("📥 Full payload: %s", payload)
+        logger.info("product-search query=%s species=%s", payload.query, payload.species)
+        logger.debug("product-search filters=%s", payload.filters)
         
         # Call our direct OpenSearch function
-        logger.info("🔍 Calling direct OpenSearch integration...")
         search_result = await search_products_opensearch(
             query=payload.query,
             species=payload.species,
-            filters=payload.filters
+            filters=payload.filters,
+            search_after=payload.search_after or ""
         )
         
-        logger.info("📤 OpenSearch result: %s", json.dumps(search_result, indent=2))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("📤 OpenSearch result: %s", json.dumps(search_result))
         
-        # Return the result in the same format as Python agent
+        # The search result is embedded as an object, not a pre-encoded JSON string,
+        # so it is serialized once with the rest of the response
         result = {
             "status": "success",
-            "response": json.dumps(search_result, ensure_ascii=False),
+            "response": search_result,
             "query": payload.query,
             "species": payload.species,
-            "filters": payload.filters
+            "filters": payload.filters.model_dump(exclude_defaults=True)
         }
         
-        logger.info("✅ PRODUCT SEARCH completed successfully")
-        logger.info("=" * 70)
         return result
         
     except Exception as e:
         logger.error("PRODUCT SEARCH failed: %s", str(e), exc_info=True)
         raise HTTPException(status_code=500, detail=f"Product search error: {str(e)}")
 
+@app.post("/api/agents/product-search/batch")
+async def search_products_batch(payload: ProductSearchBatchRequest):
+    """
+    Runs several product searches in one OpenSearch _msearch round trip.
+    "response" holds one result per search, in request order.
+    """
+    try:
+        logger.info("PRODUCT SEARCH BATCH: %d searches", len(payload.searches))
+        search_results = await search_products_opensearch_batch(payload.searches)
+        return {
+            "status": "success",
+            "response": search_results,
+            "count": len(search_results)
+        }
+    except Exception as e:
+        logger.error("PRODUCT SEARCH BATCH failed: %s", str(e), exc_info=True)
+        raise HTTPException(status_code=500, detail=f"Product search error: {str(e)}")
+
 if __name__ == "__main__":
     import uvicorn
     # For local dev; in prod run behind a proper ASGI server